@@ -0,0 +1,94 @@
+import os
+import threading
+import time
+
+import pika
+
+from shared.publisher import QUEUE_MAX_LENGTH, SINK_QUEUES
+
+# Readings waiting in the fullest sink queue above which the API stops taking
+# new ones, well before the broker itself starts rejecting them
+HIGH_WATER_MARK = int(os.environ.get("INGEST_HIGH_WATER_MARK", QUEUE_MAX_LENGTH * 8 // 10))
+# Seconds a queue depth is trusted before it is read again
+CHECK_INTERVAL = float(os.environ.get("INGEST_CHECK_INTERVAL", 1))
+# Seconds clients are told to wait before retrying a shed request
+RETRY_AFTER = int(os.environ.get("INGEST_RETRY_AFTER", 5))
+
+
+class AdmissionController:
+    # Decides whether the API takes more readings, based on how far the
+    # consumers are behind. The depths come from passive queue declares on a
+    # connection of its own. Only one request thread reads them when the
+    # cached value is stale, the others keep using the last one.
+
+    def __init__(self, high_water_mark=HIGH_WATER_MARK, check_interval=CHECK_INTERVAL):
+        credentials = pika.PlainCredentials('guest', 'guest')
+        # The connection is only used when a request checks the depths, no
+        # thread would answer the heartbeats in between
+        self.parameters = pika.ConnectionParameters(os.environ.get("RABBITMQ_HOST", "rabbitmq"),
+                                       5672,
+                                       '/',
+                                       credentials,
+                                       heartbeat=0)
+        self.high_water_mark = high_water_mark
+        self.check_interval = check_interval
+        self.conn = None
+        self.channel = None
+        self.depths = {}
+        self.checked_at = 0
+        self.shed = 0
+        self._lock = threading.Lock()
+
+    def admit(self):
+        # False when the readings should be turned away
+        if time.monotonic() - self.checked_at > self.check_interval and self._lock.acquire(blocking=False):
+            try:
+                self._check()
+            finally:
+                self._lock.release()
+        if self.depths and max(self.depths.values()) >= self.high_water_mark:
+            self.shed += 1
+            return False
+        return True
+
+    def _check(self):
+        try:
+            if self.conn is None or not self.conn.is_open:
+                self.conn = pika.BlockingConnection(self.parameters)
+                self.channel = self.conn.channel()
+            depths = {}
+            for queue in SINK_QUEUES.values():
+                depths[queue] = self.channel.queue_declare(queue=queue, passive=True).method.message_count
+            self.depths = depths
+        except pika.exceptions.AMQPError as e:
+            # Unknown depth, requests are let through and the publisher
+            # reports the broker problem itself. A missing queue closes the
+            # channel, so the connection is opened again next time.
+            print("Could not read the queue depths:", e)
+            self.depths = {}
+            self.close()
+        self.checked_at = time.monotonic()
+
+    def stats(self):
+        return {"depths": dict(self.depths), "high_water_mark": self.high_water_mark, "shed": self.shed}
+
+    def close(self):
+        conn, self.conn, self.channel = self.conn, None, None
+        if conn is not None and conn.is_open:
+            try:
+                conn.close()
+            except pika.exceptions.AMQPError:
+                pass
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_admission_controller():
+    global _controller
+    if _controller is None:
+        with _controller_lock:
+            if _controller is None:
+                _controller = AdmissionController()
+    return _controller
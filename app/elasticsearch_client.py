@@ -2,12 +2,12 @@ from elasticsearch import Elasticsearch
 import time
 
 class ElasticsearchClient:
-    def __init__(self, host="localhost", port="9200"):
+    def __init__(self, host="localhost", port="9200", connections=10, wait=True):
         self.host = host
         self.port = port
-        self.client = Elasticsearch(["http://"+self.host+":"+self.port])
+        self.client = Elasticsearch(["http://"+self.host+":"+self.port], connections_per_node=connections)
 
-        while not self.ping():
+        while wait and not self.ping():
             print("Waiting for Elasticsearch to start...")
             time.sleep(1)
 
@@ -25,8 +25,11 @@ class ElasticsearchClient:
     def close(self):
         self.client.close()
 
-    def create_index(self, index_name):
-        return self.client.indices.create(index=index_name)
+    def create_index(self, index_name, settings=None):
+        return self.client.indices.create(index=index_name, settings=settings)
+
+    def index_exists(self, index_name):
+        return self.client.indices.exists(index=index_name)
     
     def create_mapping(self, index_name, mapping):
         return self.client.indices.put_mapping(index=index_name, body=mapping)
@@ -1,10 +1,10 @@
 from pymongo import MongoClient
 
 class MongoDBClient:
-    def __init__(self, host="localhost", port=27017):
+    def __init__(self, host="localhost", port=27017, max_pool_size=100):
         self.host = host
         self.port = port
-        self.client = MongoClient(host, port)
+        self.client = MongoClient(host, port, maxPoolSize=max_pool_size)
         self.database = None
         self.collection = None
 
@@ -1,11 +1,11 @@
 import redis
 
 class RedisClient:
-    def __init__(self, host='localhost', port=6379, db=0):
+    def __init__(self, host='localhost', port=6379, db=0, max_connections=None):
         self._host = host
         self._port = port
         self._db = db
-        self._client = redis.Redis(host=self._host, port=self._port, db=self._db)
+        self._client = redis.Redis(host=self._host, port=self._port, db=self._db, max_connections=max_connections)
     
     def close(self):
         self._client.close()
@@ -19,11 +19,23 @@ class RedisClient:
     def set(self, key, value):
         return self._client.set(key, value)
     
+    def mget(self, keys):
+        return self._client.mget(keys)
+
     def delete(self, key):
         return self._client.delete(key)
     
     def keys(self, pattern):
         return self._client.keys(pattern)
+
+    def smembers(self, key):
+        return self._client.smembers(key)
+
+    def pipeline(self, transaction=True):
+        return self._client.pipeline(transaction=transaction)
+
+    def register_script(self, script):
+        return self._client.register_script(script)
     
     def clearAll(self):
         for key in self._client.keys("*"):
@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+
+from app.cassandra_client import CassandraClient
+from app.elasticsearch_client import ElasticsearchClient
+from app.mongodb_client import MongoDBClient
+from app.redis_client import RedisClient
+from app.timing import instrument
+
+MONGO_POOL_SIZE = int(os.environ.get("MONGO_POOL_SIZE", 100))
+REDIS_POOL_SIZE = int(os.environ.get("REDIS_POOL_SIZE", 50))
+ES_POOL_SIZE = int(os.environ.get("ES_POOL_SIZE", 10))
+HEALTHCHECK_INTERVAL = int(os.environ.get("HEALTHCHECK_INTERVAL", 10))
+
+
+class ClientRegistry:
+    # Holds one pooled client per store for the whole life of the API. The
+    # clients are thread-safe and keep their own connection pools, so every
+    # request borrows a connection instead of opening one. Each client is
+    # built on first use, so a store that is down only breaks the endpoints
+    # that need it.
+
+    factories = {
+        'redis': lambda: RedisClient(host="redis", max_connections=REDIS_POOL_SIZE),
+        'mongodb': lambda: MongoDBClient(host="mongodb", max_pool_size=MONGO_POOL_SIZE),
+        'elasticsearch': lambda: ElasticsearchClient(host="elasticsearch", connections=ES_POOL_SIZE, wait=False),
+        'cassandra': lambda: CassandraClient(hosts=["cassandra"]),
+    }
+
+    checks = {
+        'redis': lambda client: client.ping(),
+        'mongodb': lambda client: client.ping(),
+        'elasticsearch': lambda client: client.ping(),
+        'cassandra': lambda client: client.execute("SELECT release_version FROM system.local"),
+    }
+
+    def __init__(self):
+        self._clients = {}
+        # One lock per store, so a slow Cassandra connect does not hold up
+        # the other clients
+        self._locks = {name: threading.Lock() for name in self.factories}
+        self._stop = threading.Event()
+        self.health = {}
+
+    @property
+    def redis(self) -> RedisClient:
+        return self.get('redis')
+
+    @property
+    def mongodb(self) -> MongoDBClient:
+        return self.get('mongodb')
+
+    @property
+    def elasticsearch(self) -> ElasticsearchClient:
+        return self.get('elasticsearch')
+
+    @property
+    def cassandra(self) -> CassandraClient:
+        return self.get('cassandra')
+
+    def get(self, name):
+        client = self._clients.get(name)
+        if client is None:
+            with self._locks[name]:
+                client = self._clients.get(name)
+                if client is None:
+                    client = self._clients[name] = instrument(name, self.factories[name]())
+        return client
+
+    def start(self):
+        # One checker thread per store, so a store that hangs does not delay
+        # the others. The checks also open the clients in the background, so
+        # the first requests find them connected.
+        for name in self.checks:
+            threading.Thread(target=self._check_health, args=(name,), name=f"registry-health-{name}", daemon=True).start()
+
+    def _check_health(self, name):
+        check = self.checks[name]
+        while not self._stop.is_set():
+            try:
+                ok = bool(check(self.get(name)))
+                self.health[name] = {"ok": ok, "checked_at": time.time()}
+            except Exception as e:
+                self.health[name] = {"ok": False, "checked_at": time.time(), "error": str(e)}
+            self._stop.wait(HEALTHCHECK_INTERVAL)
+
+    def close(self):
+        self._stop.set()
+        for name, client in list(self._clients.items()):
+            client.close()
+            del self._clients[name]
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> ClientRegistry:
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ClientRegistry()
+                _registry.start()
+    return _registry
+
+
+def close_registry():
+    global _registry
+    with _registry_lock:
+        if _registry is not None:
+            _registry.close()
+            _registry = None
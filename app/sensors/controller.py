@@ -1,4 +1,6 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from pydantic import ValidationError
 from sqlalchemy.orm import Session
 
 from app.database import SessionLocal
@@ -7,8 +9,20 @@ from app.mongodb_client import MongoDBClient
 from app.elasticsearch_client import ElasticsearchClient 
 from app.timescale import Timescale
 from app.cassandra_client import CassandraClient
+from app.registry import get_registry
+from app.admission import RETRY_AFTER, get_admission_controller
+from app.timing import instrument
+from shared.publisher import PublisherPool, PublishError, get_publisher_pool
+from shared.sensors.schemas import SensorDataMessage
 from . import models, schemas, repository
 import json
+import os
+
+# Readings of a batch request are checked and published this many at a time
+BATCH_CHUNK_SIZE = int(os.environ.get("BATCH_CHUNK_SIZE", 500))
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", 10000))
+# Most sensors /sensors/near returns in one request
+NEAR_MAX_LIMIT = int(os.environ.get("NEAR_MAX_LIMIT", 1000))
 
 # Dependency to get db session
 def get_db():
@@ -21,41 +35,40 @@ def get_db():
 def get_timescale():
     ts = Timescale()
     try:
-        yield ts
+        yield instrument('timescale', ts)
     finally:
         ts.close()
 
+# The store clients below are shared for the whole life of the app and pool
+# their connections, see app/registry.py
+
 # Dependency to get redis client
 def get_redis_client():
-    redis = RedisClient(host="redis")
-    try:
-        yield redis
-    finally:
-        redis.close()
+    return get_registry().redis
 
 # Dependency to get mongodb client
 def get_mongodb_client():
-    mongodb = MongoDBClient(host="mongodb")
-    try:
-        yield mongodb
-    finally:
-        mongodb.close()
+    return get_registry().mongodb
 
 # Dependency to get elastic_search client
 def get_elastic_search():
-    es = ElasticsearchClient(host="elasticsearch")
-    try:
-        yield es
-    finally:
-        es.close()
+    return get_registry().elasticsearch
 
 # Dependency to get cassandra client
 def get_cassandra_client():
-    cassandra = CassandraClient(hosts=["cassandra"])
-    try:
-        yield cassandra
-    finally:
-        cassandra.close()
+    return get_registry().cassandra
+
+# Dependency that sheds readings while the consumers are too far behind, see
+# app/admission.py
+def check_admission():
+    if not get_admission_controller().admit():
+        raise HTTPException(status_code=503, detail="Too many readings waiting to be processed, try again later",
+                            headers={"Retry-After": str(RETRY_AFTER)})
+
+# Dependency to get the queue publisher, a process-wide pool whose broker
+# connections run in their own threads and are shared by every request
+def get_publisher():
+    return get_publisher_pool()
 
 
 router = APIRouter(
@@ -66,10 +79,11 @@ router = APIRouter(
 
 
 # 🙋🏽‍♀️ Add here the route to get a list of sensors near to a given location
+# radius is in metres, at most `limit` sensors come back, nearest first
 @router.get("/near")
-def get_sensors_near(latitude: float, longitude: float, radius: float, db: Session = Depends(get_db),mongodb_client: MongoDBClient = Depends(get_mongodb_client), redis_client: RedisClient = Depends(get_redis_client)):
+def get_sensors_near(latitude: float, longitude: float, radius: float, limit: int = Query(100, ge=1, le=NEAR_MAX_LIMIT), db: Session = Depends(get_db),mongodb_client: MongoDBClient = Depends(get_mongodb_client), redis_client: RedisClient = Depends(get_redis_client)):
     #raise HTTPException(status_code=404, detail="Not implemented")
-    data = repository.get_sensors_near(mongodb=mongodb_client, latitude=latitude, longitude=longitude, radius=radius, db=db, redis=redis_client)
+    data = repository.get_sensors_near(mongodb=mongodb_client, latitude=latitude, longitude=longitude, radius=radius, db=db, redis=redis_client, limit=limit)
     return json.loads(data)
 
 # 🙋🏽‍♀️ Add here the route to search sensors by query to Elasticsearch
@@ -87,9 +101,9 @@ def search_sensors(query: str, size: int = 10, search_type: str = "match", db: S
 # 🙋🏽‍♀️ Add here the route to get the temperature values of a sensor
 
 @router.get("/temperature/values")
-def get_temperature_values(db: Session = Depends(get_db), cassandra_client: CassandraClient = Depends(get_cassandra_client), mongodb_client: MongoDBClient = Depends(get_mongodb_client)):
+def get_temperature_values(db: Session = Depends(get_db), redis_client: RedisClient = Depends(get_redis_client), mongodb_client: MongoDBClient = Depends(get_mongodb_client)):
     #raise HTTPException(status_code=404, detail="Not implemented")
-    return repository.get_temperature_values(db=db, cassandra=cassandra_client, mongodb_client=mongodb_client)
+    return repository.get_temperature_values(db=db, redis=redis_client, mongodb_client=mongodb_client)
 
 @router.get("/quantity_by_type")
 def get_sensors_quantity(db: Session = Depends(get_db), cassandra_client: CassandraClient = Depends(get_cassandra_client)):
@@ -109,12 +123,12 @@ def get_sensors(db: Session = Depends(get_db)):
 
 # 🙋🏽‍♀️ Add here the route to create a sensor  Done
 @router.post("")
-def create_sensor(sensor: schemas.SensorCreate, db: Session = Depends(get_db), mongodb_client: MongoDBClient = Depends(get_mongodb_client), es: ElasticsearchClient = Depends(get_elastic_search), cassandra_client: CassandraClient = Depends(get_cassandra_client)):
+def create_sensor(sensor: schemas.SensorCreate, db: Session = Depends(get_db), mongodb_client: MongoDBClient = Depends(get_mongodb_client), es: ElasticsearchClient = Depends(get_elastic_search), cassandra_client: CassandraClient = Depends(get_cassandra_client), publisher: PublisherPool = Depends(get_publisher)):
     db_sensor = repository.get_sensor_by_name(db, sensor.name)
     if db_sensor:
         raise HTTPException(status_code=400, detail="Sensor with same name already registered")
     #raise HTTPException(status_code=404, detail="Not implemented")
-    return repository.create_sensor(db=db, sensor=sensor, mongodb_client=mongodb_client, cassandra=cassandra_client, es=es)
+    return repository.create_sensor(db=db, sensor=sensor, mongodb_client=mongodb_client, cassandra=cassandra_client, es=es, publisher=publisher)
 
 
 # 🙋🏽‍♀️ Add here the route to get a sensor by id   Done
@@ -127,22 +141,86 @@ def get_sensor(sensor_id: int, db: Session = Depends(get_db), mongodb_client: Mo
 
 # 🙋🏽‍♀️ Add here the route to delete a sensor  Done
 @router.delete("/{sensor_id}")
-def delete_sensor(sensor_id: int, db: Session = Depends(get_db), mongodb_client: MongoDBClient = Depends(get_mongodb_client), es: ElasticsearchClient = Depends(get_elastic_search)):
+def delete_sensor(sensor_id: int, db: Session = Depends(get_db), mongodb_client: MongoDBClient = Depends(get_mongodb_client), publisher: PublisherPool = Depends(get_publisher)):
     db_sensor = repository.get_sensor(db, sensor_id, mongodb_client)
     if db_sensor is None:
         raise HTTPException(status_code=404, detail="Sensor not found")
     #raise HTTPException(status_code=404, detail="Not implemented")
-    return repository.delete_sensor(db=db, sensor_id=sensor_id, mongodb_client=mongodb_client, es=es)
+    return repository.delete_sensor(db=db, sensor_id=sensor_id, mongodb_client=mongodb_client, publisher=publisher)
     
 
 # 🙋🏽‍♀️ Add here the route to update a sensor
-@router.post("/{sensor_id}/data")
-def record_data(sensor_id: int, data: schemas.SensorData, db: Session = Depends(get_db) ,redis_client: RedisClient = Depends(get_redis_client), timescale: Timescale = Depends(get_timescale), mongodb_client: MongoDBClient = Depends(get_mongodb_client), cassandra_client: CassandraClient = Depends(get_cassandra_client)):
+@router.post("/{sensor_id}/data", status_code=202, dependencies=[Depends(check_admission)])
+def record_data(sensor_id: int, data: schemas.SensorData, db: Session = Depends(get_db), mongodb_client: MongoDBClient = Depends(get_mongodb_client), publisher: PublisherPool = Depends(get_publisher)):
     #raise HTTPException(status_code=404, detail="Not implemented")
     db_sensor = repository.get_sensor(db, sensor_id, mongodb_client)
     if db_sensor is None:
         raise HTTPException(status_code=404, detail="Sensor not found")
-    return repository.record_data(redis=redis_client, sensor_id=sensor_id, data=data, cassandra=cassandra_client, timescale=timescale)
+    try:
+        return repository.record_data(publisher=publisher, sensor_id=sensor_id, data=data)
+    except PublishError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(RETRY_AFTER)})
+
+# Many readings in one request, as a JSON array or as NDJSON
+# (Content-Type: application/x-ndjson, one reading per line, read as it
+# streams in). Every item is {"sensor_id": ..., <SensorData fields>} and gets
+# its own status: 202 queued, 404 unknown sensor, 422 invalid, 503 broker,
+# 413 past BATCH_MAX_ITEMS. A JSON array over the limit is refused whole
+# before anything is published.
+@router.post("/data/batch", dependencies=[Depends(check_admission)])
+async def record_data_batch(request: Request, mongodb_client: MongoDBClient = Depends(get_mongodb_client), publisher: PublisherPool = Depends(get_publisher)):
+    results = []
+    chunk = []
+    count = 0
+    async for item in read_batch(request):
+        if count >= BATCH_MAX_ITEMS:
+            # Earlier NDJSON lines may be queued already, so the request is
+            # not failed as a whole
+            results.append({"index": count, "status": 413, "detail": f"At most {BATCH_MAX_ITEMS} readings per request"})
+            count += 1
+            continue
+        try:
+            message = SensorDataMessage.parse_raw(item) if isinstance(item, bytes) else SensorDataMessage.parse_obj(item)
+            chunk.append((count, message))
+        except ValidationError as e:
+            results.append({"index": count, "status": 422, "detail": e.errors()})
+        count += 1
+        if len(chunk) >= BATCH_CHUNK_SIZE:
+            results += await run_in_threadpool(repository.record_data_batch, publisher, mongodb_client, chunk)
+            chunk = []
+    if chunk:
+        results += await run_in_threadpool(repository.record_data_batch, publisher, mongodb_client, chunk)
+
+    results.sort(key=lambda result: result["index"])
+    accepted = sum(1 for result in results if result["status"] == 202)
+    return {"accepted": accepted, "rejected": len(results) - accepted, "items": results}
+
+async def read_batch(request: Request):
+    # Yields the NDJSON lines (as bytes, a line that is not UTF-8 fails
+    # validation like any other bad line) as they arrive, or the items of a
+    # JSON array
+    if request.headers.get("content-type", "").startswith(("application/x-ndjson", "application/jsonl")):
+        buffer = b""
+        async for data in request.stream():
+            buffer += data
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    yield line
+        if buffer.strip():
+            yield buffer
+        return
+
+    try:
+        items = json.loads(await request.body())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="The body must be a JSON array or NDJSON")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="The body must be a JSON array or NDJSON")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_ITEMS} readings per request")
+    for item in items:
+        yield item
 
 # 🙋🏽‍♀️ Add here the route to get data from a sensor
 @router.get("/{sensor_id}/data")
@@ -3,17 +3,43 @@ from sqlalchemy.orm import Session
 from typing import List, Optional
 import json
 from . import models, schemas
-import time
-from datetime import datetime, timedelta
+from shared.cassandra_schema import create_schema as create_cassandra_schema
+from shared.publisher import PublisherPool, PublishError, SENSOR_EVENTS_EXCHANGE
+from shared.sensor_cache import get_sensor_cache
+from shared.sensors.schemas import SensorDataMessage, SensorEvent
+from shared import search_index, temperature_stats
+
+# Mongo fields that are not part of the sensor returned by the API. location
+# is the GeoJSON copy of latitude/longitude used by the 2dsphere index.
+SENSOR_PROJECTION = {"_id": 0, "location": 0}
 
 def get_sensor(db: Session, sensor_id: int, mongodb_client: Session) -> Optional[models.Sensor]:
-    
+    # Served from the process cache, see shared/sensor_cache.py
+    return get_sensor_cache().get(sensor_id, lambda sensor_id: find_sensor(mongodb_client, sensor_id))
+
+def find_sensor(mongodb_client: Session, sensor_id: int):
     mongodb_client.getDatabase("mydatabase")
     mycol = mongodb_client.getCollection("sensors")
-    doc = mycol.find_one({"id": sensor_id})
-    if doc:
-        del doc['_id']
-    return doc
+    return mycol.find_one({"id": sensor_id}, SENSOR_PROJECTION)
+
+def publish_sensor_event(publisher: PublisherPool, event: SensorEvent):
+    # This process evicts the sensor right away, the other ones when the
+    # event reaches them, and the elasticsearch consumer indexes or deletes
+    # it. If the broker is down the cached entries expire with the TTL and
+    # the search index catches up with `python -m shared.search_index reindex`.
+    get_sensor_cache().invalidate(event.sensor_id)
+    try:
+        publisher.publish(event, exchange=SENSOR_EVENTS_EXCHANGE)
+    except PublishError as e:
+        print("Could not publish sensor event:", e)
+
+def get_sensors_by_ids(mongodb_client: Session, sensor_ids) -> dict:
+    # Metadata of many sensors in one round trip, keyed by sensor id. Ids
+    # that are not in mongo are left out.
+    mongodb_client.getDatabase("mydatabase")
+    mycol = mongodb_client.getCollection("sensors")
+    docs = mycol.find({"id": {"$in": list(set(sensor_ids))}}, SENSOR_PROJECTION)
+    return {doc['id']: doc for doc in docs}
 
 def get_sensor_by_name(db: Session, name: str) -> Optional[models.Sensor]:
     return db.query(models.Sensor).filter(models.Sensor.name == name).first()
@@ -22,27 +48,29 @@ def get_sensors(db: Session, skip: int = 0, limit: int = 100) -> List[models.Sen
     return db.query(models.Sensor).offset(skip).limit(limit).all()
 
 def create_elasticsearch(es: Session):
-    es_index_name='index_sensors'
-    es.create_index(es_index_name)
-    mapping = {
-        'properties': {
-            'name': {'type': 'text'},
-            'description': {'type': 'text'},
-            'type': {'type': 'text'}
-        }
-    }
-    es.create_mapping(es_index_name,mapping)
+    # Idempotent, run at startup and before the first sensor is created. The
+    # documents themselves are written by the elasticsearch consumer.
+    search_index.ensure_index(es)
+
+
+def create_mongodb_indexes(mongodb_client: Session):
+    # Idempotent, run at startup and before the first sensor is created.
+    # Sensors stored before the location field existed get it here.
+    mongodb_client.getDatabase("mydatabase")
+    mycol = mongodb_client.getCollection("sensors")
+    mycol.update_many({"location": {"$exists": False}},
+                      [{"$set": {"location": {"type": "Point", "coordinates": ["$longitude", "$latitude"]}}}])
+    mycol.create_index([("location", "2dsphere")])
+    mycol.create_index("id")
 
     
-def create_sensor(db: Session, sensor: schemas.SensorCreate, mongodb_client: Session, cassandra: Session, es: Session) -> models.Sensor:
+def create_sensor(db: Session, sensor: schemas.SensorCreate, mongodb_client: Session, cassandra: Session, es: Session, publisher: PublisherPool) -> models.Sensor:
     if len(get_sensors(db)) == 0:
         create_elasticsearch(es)
     
     if len(get_sensors(db)) == 0:
-        cassandra.execute("CREATE KEYSPACE sensor WITH replication =  {'class': 'SimpleStrategy', 'replication_factor' : 3};")
-        cassandra.execute("CREATE TABLE sensor.temperature_values (id int, value_id int, temperature decimal, PRIMARY KEY (id, value_id)) WITH comment = 'Find values temperature'")
-        cassandra.execute("CREATE TABLE sensor.types (type text PRIMARY KEY, count counter) WITH comment = 'Find number of types of sensor';")
-        cassandra.execute("CREATE TABLE sensor.battery (id int PRIMARY KEY, battery_level decimal) WITH comment = 'Find sensor with battery level <20%';")
+        create_cassandra_schema(cassandra)
+        create_mongodb_indexes(mongodb_client)
 
 
     # Puting data in database
@@ -51,15 +79,7 @@ def create_sensor(db: Session, sensor: schemas.SensorCreate, mongodb_client: Ses
     db.commit()
     db.refresh(db_sensor)
 
-    
-    # Puting data in elasticsearch
-    es_index_name='index_sensors'
-    es_doc={
-            'name': sensor.name,
-            'description': sensor.description,
-            'type': sensor.type
-        }
-    es.index_document(es_index_name, es_doc)
+    # Elasticsearch is updated by the consumer from the sensor event below
 
     # Puting data in cassandra
     cassandra.execute("UPDATE sensor.types SET count = count + 1 WHERE type = %s;", (sensor.type,))
@@ -74,100 +94,90 @@ def create_sensor(db: Session, sensor: schemas.SensorCreate, mongodb_client: Ses
     }
     for key, value in sensor.dict().items():
         mydoc[key] = value
+    mydoc["location"] = {"type": "Point", "coordinates": [sensor.longitude, sensor.latitude]}
         
     mycol.insert_one(mydoc)
 
-    doc = mycol.find_one({"id": db_sensor.id})
+    doc = mycol.find_one({"id": db_sensor.id}, SENSOR_PROJECTION)
     if doc:
-        del doc['_id']
+        publish_sensor_event(publisher, SensorEvent(event="created", sensor_id=db_sensor.id, sensor=doc))
         
     return doc
 
 
-def record_data(redis: Session, sensor_id: int, data: schemas.SensorData, cassandra: Session, timescale: Session) -> schemas.Sensor:
-    
-    # Save data in table
-    query = """
-        INSERT INTO sensor_data (id, velocity, temperature, humidity, battery_level, last_seen)
-        VALUES (%s, %s, %s, %s, %s, %s)
-    """
-    timescale.execute(query, (sensor_id, data.velocity, data.temperature, data.humidity, data.battery_level, data.last_seen))
-    
-    # Save data in cassandra
-    result_set = cassandra.execute("SELECT * FROM sensor.battery WHERE id = %s;", (sensor_id,))
-    existing_row = result_set.one() if not result_set.current_rows == 0 else None
-
-    if existing_row and data.battery_level < 0.2:
-        cassandra.execute("UPDATE sensor.battery SET battery_level = %s WHERE id = %s;", (data.battery_level, sensor_id))
-    elif not existing_row and data.battery_level < 0.2:
-        cassandra.execute("INSERT INTO sensor.battery (id, battery_level) VALUES (%s, %s);", (sensor_id, data.battery_level))
-
-         
-    if data.temperature != None:
-        value_id = cassandra.execute("SELECT COUNT(*) AS num_rows FROM sensor.temperature_values;")
-        cassandra.execute("INSERT INTO sensor.temperature_values (id, value_id, temperature) VALUES (%s, %s, %s);", (sensor_id, value_id.one().num_rows, data.temperature))
-
-    # Save data in redis
-    db_sensordata = json.dumps(data.dict())
-    return redis._client.set(sensor_id, db_sensordata)
+def record_data(publisher: PublisherPool, sensor_id: int, data: schemas.SensorData) -> schemas.SensorData:
+    # The consumer writes the reading to redis, timescale and cassandra, here
+    # we only wait for the broker to take it
+    message = SensorDataMessage(sensor_id=sensor_id, **data.dict())
+    publisher.publish(message)
+    return data
+
+
+def record_data_batch(publisher: PublisherPool, mongodb_client: Session, items) -> list:
+    # items are (position in the request, SensorDataMessage). The sensors are
+    # checked in one cached lookup and the known ones published together.
+    docs = get_sensor_cache().get_many([message.sensor_id for _, message in items],
+                                       lambda sensor_ids: get_sensors_by_ids(mongodb_client, sensor_ids))
+
+    results = []
+    known = []
+    for index, message in items:
+        if message.sensor_id in docs:
+            known.append((index, message))
+        else:
+            results.append({"index": index, "status": 404, "detail": "Sensor not found"})
+
+    if known:
+        try:
+            acked = publisher.publish_many([message for _, message in known])
+            detail = "The broker did not accept the message"
+        except PublishError as e:
+            acked = [False] * len(known)
+            detail = str(e)
+        for (index, _), ok in zip(known, acked):
+            results.append({"index": index, "status": 202} if ok else {"index": index, "status": 503, "detail": detail})
+    return results
+
+
+# Bucket name -> (continuous aggregate, bucket width)
+BUCKETS = {
+    'hour': ('sensor_data_hourly', '1 hour'),
+    'day': ('sensor_data_daily', '1 day'),
+    'week': ('sensor_data_weekly', '1 week'),
+    'month': ('sensor_data_monthly', '1 month'),
+    'year': ('sensor_data_yearly', '1 year'),
+}
 
 
 def get_data(redis: Session, sensor_id: int, db: Session, mongodb_client: Session, timescale: Session = None,  from_: str = None, to: str = None, bucket: str = None) -> schemas.Sensor:
     
     # Mirem el que ens estan demanant
     if to:
-        dic = {'hour': '1 h', 'day': '1 day', 'week': '1 week', 'month': '1 month', 'year': '1 year'}
-       
-        # Fem les agregacions        
-        query = """
-            CREATE MATERIALIZED VIEW materialized_view
-            WITH (timescaledb.continuous) AS
-            SELECT
-                id, 
-                AVG(velocity) AS vel, 
-                AVG(temperature) AS temp, 
-                AVG(humidity) AS hum,
-                MIN(battery_level) AS bat, 
-                time_bucket(%s, last_seen) AS time
-            FROM
-                sensor_data
-            GROUP BY
-               id,  time_bucket(%s, last_seen);
-        """
-        timescale.execute(query, (dic[bucket], dic[bucket]))
-        
-        # Agafem les dades de l'interval de temps que volem
-        
-        query = """
-            SELECT * FROM materialized_view
-            WHERE time >= %s
+        # Les agregacions son vistes continues de timescale (migrations_ts)
+        if bucket is None:
+            bucket = 'day'
+        if bucket not in BUCKETS:
+            raise HTTPException(status_code=400, detail="Invalid bucket size")
+        view, interval = BUCKETS[bucket]
+
+        # Agafem les dades de l'interval de temps que volem. El from_ s'arrodoneix
+        # a l'inici del seu bucket amb el mateix time_bucket de la vista, aixi
+        # una setmana que comenca abans del from_ tambe hi entra
+        query = f"""
+            SELECT id, vel, temp, hum, bat, time FROM {view}
+            WHERE time >= time_bucket(%s::interval, %s::timestamp)
             AND time <= %s
-            AND id = %s;
+            AND id = %s
+            ORDER BY time;
         """
-        if bucket == 'week':
-            # When we do the week table, all the dates go back two days 
-            date_object = datetime.fromisoformat(from_[:-1])
-            two_days_ago_from = date_object - timedelta(days=2)
-            two_days_ago_string_from = two_days_ago_from.strftime("%Y-%m-%dT%H:%M:%S.%f") + "Z"
-            date_object = datetime.fromisoformat(to[:-1]) 
-            two_days_ago_to = date_object - timedelta(days=2)
-            two_days_ago_string_to = two_days_ago_to.strftime("%Y-%m-%dT%H:%M:%S.%f") + "Z"
-
-            timescale.execute(query, (two_days_ago_string_from, two_days_ago_string_to, sensor_id))
-        else: 
-            timescale.execute(query, (from_, to, sensor_id))
-            
-        data = timescale.getCursor().fetchall()
-
-        # Eliminem la taula
-        query = """
-            DROP MATERIALIZED VIEW materialized_view;
-        """
-        timescale.execute(query) 
-
-        return data
+        timescale.execute(query, (interval, from_, to, sensor_id))
+        return timescale.getCursor().fetchall()
     else:
-        data_str = redis._client.get(sensor_id)
+        data_str = redis.get(sensor_id)
+        if data_str is None:
+            # Readings are written by the consumer, a sensor can be asked
+            # for before its first one has made it to redis
+            raise HTTPException(status_code=404, detail="No readings for this sensor yet")
 
         decoded_data =data_str.decode()
         db_sensordata = json.loads(decoded_data)
@@ -177,7 +187,7 @@ def get_data(redis: Session, sensor_id: int, db: Session, mongodb_client: Sessio
     
     
 
-def delete_sensor(db: Session, sensor_id: int, mongodb_client: Session, es: Session):
+def delete_sensor(db: Session, sensor_id: int, mongodb_client: Session, publisher: PublisherPool):
     db_sensor = db.query(models.Sensor).filter(models.Sensor.id == sensor_id).first()
     if db_sensor is None:
         raise HTTPException(status_code=404, detail="Sensor not found")
@@ -187,41 +197,50 @@ def delete_sensor(db: Session, sensor_id: int, mongodb_client: Session, es: Sess
     mongodb_client.getDatabase("mydatabase")
     mycol = mongodb_client.getCollection("sensors")
     mycol.delete_one({"id": sensor_id})
+    publish_sensor_event(publisher, SensorEvent(event="deleted", sensor_id=sensor_id, sensor={"id": sensor_id, "name": db_sensor.name}))
 
-    es_index_name='index_sensors'
-    query = {
-            'query': {
-                'term': {
-                    'name.keyword': db_sensor.name
-                }
-            }
-        }
-    
-    results = es.search(es_index_name, query)
-    for hit in results['hits']['hits']:
-        index_name = hit['_id']
-        es.client.delete(index=es_index_name, id=index_name)
     return db_sensor
 
-def get_sensors_near(mongodb: Session, latitude: float, longitude: float, radius: float, db: Session, redis: Session):
+def get_sensors_near(mongodb: Session, latitude: float, longitude: float, radius: float, db: Session, redis: Session, limit: int = 100):
+    # radius is in metres, the 2dsphere index on location answers it without
+    # scanning the collection. $geoNear already returns them nearest first,
+    # so only the `limit` kept are sorted again to put sensors at the same
+    # distance in id order. Which of them make the cut at the limit is up
+    # to the index.
     mongodb.getDatabase("mydatabase")
     mycol = mongodb.getCollection("sensors")
-    query = {
-        "latitude": {"$gte": latitude - radius, "$lte": latitude + radius},
-        "longitude": {"$gte": longitude - radius, "$lte": longitude + radius}
-    }
-    sensors = mycol.find(query)
+    pipeline = [
+        {"$geoNear": {
+            "near": {"type": "Point", "coordinates": [longitude, latitude]},
+            "key": "location",
+            "distanceField": "distance",
+            "maxDistance": radius,
+            "spherical": True,
+        }},
+        {"$limit": limit},
+        {"$sort": {"distance": 1, "id": 1}},
+        {"$project": {"_id": 0, "id": 1, "name": 1}},
+    ]
+    sensors = list(mycol.aggregate(pipeline))
+
+    # The latest reading of every sensor in one MGET
+    readings = redis.mget([sensor['id'] for sensor in sensors]) if sensors else []
     dataSensors = []
-    for sensor in sensors:
-        db_sensor = get_sensor(db, sensor['id'], mongodb)
-        data_sensor = get_data(redis, sensor['id'], db_sensor, mongodb)
+    for sensor, reading in zip(sensors, readings):
+        data_sensor = json.loads(reading) if reading is not None else {}
+        data_sensor['id'] = sensor['id']
+        data_sensor['name'] = sensor['name']
         dataSensors.append(data_sensor)
     
     return json.dumps(dataSensors, indent=4)
 
 def search_sensors(db: Session, mongodb: Session, es: Session, query: str, size:int, search_type: str):
-    time.sleep(1)
-    es_index_name='index_sensors'
+    # Eventually consistent: sensors reach the index through the
+    # elasticsearch consumer and are searchable after its lag plus
+    # ES_REFRESH_INTERVAL. A search right after creating or deleting a
+    # sensor may not reflect it yet, indexing no longer waits for a refresh
+    # inside the request.
+    es_index_name=search_index.INDEX_NAME
 
     query_dict = json.loads(query)
     key, value = next(iter(query_dict.items()))
@@ -259,16 +278,28 @@ def search_sensors(db: Session, mongodb: Session, es: Session, query: str, size:
             }
         }
         
+    # One hit per sensor name, at most `size` of them, best first
+    query['size'] = size
+    query['collapse'] = {'field': 'name.keyword'}
+    query['sort'] = ['_score', {'id': {'order': 'asc', 'unmapped_type': 'integer'}}]
+    query['_source'] = ['id', 'name']
     results = es.search(es_index_name, query)
-    
+    hits = [hit['_source'] for hit in results['hits']['hits']]
+
+    # Documents indexed before they carried the id are resolved by name
+    names = [hit['name'] for hit in hits if 'id' not in hit]
+    ids = {}
+    if names:
+        ids = {sensor.name: sensor.id for sensor in db.query(models.Sensor).filter(models.Sensor.name.in_(names))}
+    hit_ids = [hit['id'] if 'id' in hit else ids.get(hit['name']) for hit in hits]
+    docs = get_sensors_by_ids(mongodb, [sensor_id for sensor_id in hit_ids if sensor_id is not None])
+
     sensors = []
-    count = 0
-    for hit in results['hits']['hits']:
-        sensor = get_sensor_by_name(db, hit['_source']['name'])
-        data_sensor = get_sensor(db, sensor.id, mongodb)
-        if data_sensor not in sensors and count < size:
-            sensors.append(data_sensor)
-            count += 1
+    seen = set()
+    for sensor_id in hit_ids:
+        if sensor_id in docs and sensor_id not in seen:
+            seen.add(sensor_id)
+            sensors.append(docs[sensor_id])
 
     return json.dumps(sensors, indent=4)
 
@@ -291,32 +322,38 @@ def get_low_battery_sensors(db: Session, cassandra: Session, mongodb_client: Ses
     query = """
         SELECT id, battery_level FROM sensor.battery;
     """
-    data = cassandra.execute(query)
+    data = list(cassandra.execute(query))
+    docs = get_sensors_by_ids(mongodb_client, [row.id for row in data])
 
     sensors = []
 
     for row in data:
-        data_sensor = get_sensor(db, row.id, mongodb_client)
+        if row.id not in docs:
+            continue
+        data_sensor = docs[row.id]
         data_sensor["battery_level"] = row.battery_level
         sensors.append(data_sensor)
 
     return {"sensors": sensors}
 
-def get_temperature_values(db: Session, cassandra: Session, mongodb_client: Session):
-    query = """
-        SELECT id, MIN(temperature) AS min, MAX(temperature) AS max, AVG(temperature) AS avg FROM sensor.temperature_values GROUP BY  id;
-    """
-    data = cassandra.execute(query)
-    
+def get_temperature_values(db: Session, redis: Session, mongodb_client: Session):
+    # The redis consumer keeps the min, max, sum and count of every sensor up
+    # to date, see shared/temperature_stats.py
+    stats = temperature_stats.read(redis)
+    docs = get_sensors_by_ids(mongodb_client, stats)
+
     sensors = []
 
-    for row in data:
+    for sensor_id, sensor_stats in stats.items():
+        if sensor_id not in docs:
+            continue
         temp_data = {}
-        temp_data["max_temperature"] = row.max
-        temp_data["min_temperature"] = row.min
-        temp_data["average_temperature"] = row.avg
+        temp_data["max_temperature"] = sensor_stats["max"]
+        temp_data["min_temperature"] = sensor_stats["min"]
+        # Decimal division, as the AVG of the decimal column did
+        temp_data["average_temperature"] = float(sensor_stats["sum"] / sensor_stats["count"])
 
-        data_sensor = get_sensor(db, row.id, mongodb_client)
+        data_sensor = docs[sensor_id]
         data_sensor["values"] = [temp_data]
 
         sensors.append(data_sensor)
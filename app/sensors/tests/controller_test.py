@@ -10,6 +10,17 @@ import time
 
 client = TestClient(app)
 
+def wait_for_consumer(path, ready, timeout=10):
+    """Readings and sensor events are queued and written to the databases
+    by the consumers, so the path is read again until ready(json) holds or
+    the timeout passes"""
+    deadline = time.monotonic() + timeout
+    while True:
+        response = client.get(path)
+        if (response.status_code == 200 and ready(response.json())) or time.monotonic() > deadline:
+            return response
+        time.sleep(0.1)
+
 @pytest.fixture(scope="session", autouse=True)
 def clear_dbs():
      from shared.database import engine
@@ -25,7 +36,9 @@ def clear_dbs():
      es = ElasticsearchClient(host="elasticsearch")
      es.clearIndex("sensors")  
      ts = Timescale()
-     ts.execute("DROP TABLE IF EXISTS sensor_data")
+     ts.execute("TRUNCATE sensor_data")
+     for view in ["sensor_data_hourly", "sensor_data_daily", "sensor_data_weekly", "sensor_data_monthly", "sensor_data_yearly"]:
+         ts.execute("CALL refresh_continuous_aggregate(%s, NULL, NULL)", (view,))
      ts.close()
 
      while True:
@@ -136,22 +149,28 @@ def test_create_sensor_temperatura_2():
 # Test pressent a les pràctiques: Temporals
 def test_post_sensor_data_dia_2():
     response = client.post("/sensors/1/data", json={"temperature": 15.0, "humidity": 1.0, "battery_level": 1.0, "last_seen": "2020-01-02T00:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 # Test pressent a les pràctiques: Temporals
 def test_post_sensor_data_dia_3():
     response = client.post("/sensors/1/data", json={"temperature": 18.0, "humidity": 1.0, "battery_level": 0.9, "last_seen": "2020-01-03T00:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 # Test pressent a les pràctiques: Columnars, Documental
 def test_post_sensor_data_temperatura_2():
     response = client.post("/sensors/1/data", json={"temperature": 4.0, "humidity": 1.0, "battery_level": 1.0, "last_seen": "2020-01-01T00:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
+
+def test_post_sensor_data_invalid_last_seen():
+    """Readings are written after the request returns, so a bad date is rejected up front"""
+    response = client.post("/sensors/1/data", json={"temperature": 1.0, "humidity": 1.0, "battery_level": 1.0, "last_seen": "not a date"})
+    assert response.status_code == 422
+    assert "last_seen" in response.text
 
 # Test pressent a les pràctiques: Documental
 def test_get_sensor_1_data():
     """We can get a sensor by its id"""
-    response = client.get("/sensors/1/data")
+    response = wait_for_consumer("/sensors/1/data", lambda json: json["temperature"] == 4.0)
     assert response.status_code == 200
     json = response.json()
     assert json["id"] == 1
@@ -164,12 +183,12 @@ def test_get_sensor_1_data():
 # Test pressent a les pràctiques: Columnars, Temporals, Documental, Clau-valor
 def test_post_sensor_data_temperatura_1():
     response = client.post("/sensors/1/data", json={"temperature": 1.0, "humidity": 1.0, "battery_level": 1.0, "last_seen": "2020-01-01T00:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 # Test pressent a les pràctiques: Documental, Clau-valor
 def test_get_sensor_1_data_update():
     """We can get a sensor by its id"""
-    response = client.get("/sensors/1/data")
+    response = wait_for_consumer("/sensors/1/data", lambda json: json["temperature"] == 1.0)
     assert response.status_code == 200
     json = response.json()
     assert json["id"] == 1
@@ -182,32 +201,32 @@ def test_get_sensor_1_data_update():
 # Test pressent a les pràctiques: Columnars
 def test_post_sensor_data_temperatura_3():
     response = client.post("/sensors/4/data", json={"temperature": 15.0, "humidity": 1.0, "battery_level": 1.0, "last_seen": "2020-01-02T00:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 # Test pressent a les pràctiques: Columnars
 def test_post_sensor_data_temperatura_4():
     response = client.post("/sensors/4/data", json={"temperature": 17.0, "humidity": 1.0, "battery_level": 1.0, "last_seen": "2020-01-02T00:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 # Test pressent a les pràctiques: Temporals
 def test_post_sensor_data_veolicitat_hora_1():
     response = client.post("/sensors/2/data", json={"velocity": 1.0, "battery_level": 1.0, "last_seen": "2020-01-01T00:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 # Test pressent a les pràctiques: Temporals
 def test_post_sensor_data_veolicitat_hora_2():
     response = client.post("/sensors/2/data", json={"velocity": 15.0, "battery_level": 1.0, "last_seen": "2020-01-01T01:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 # Test pressent a les pràctiques: Columnars, Documental
 def test_post_sensor_data_veolicitat_1():
     response = client.post("/sensors/2/data", json={"velocity": 1.0, "battery_level": 0.1, "last_seen": "2020-01-01T00:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 # Test pressent a les pràctiques: Documental
 def test_get_sensor_2_data():
     """We can get a sensor by its id"""
-    response = client.get("/sensors/2/data")
+    response = wait_for_consumer("/sensors/2/data", lambda json: json["battery_level"] == 0.1)
     assert response.status_code == 200
     json = response.json()
     assert json["id"] == 2
@@ -219,12 +238,12 @@ def test_get_sensor_2_data():
 # Test pressent a les pràctiques: Temporals, Documental
 def test_post_sensor_data_veolicitat_hora_3():
     response = client.post("/sensors/2/data", json={"velocity": 18.0, "battery_level": 0.9, "last_seen": "2020-01-01T02:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 # Test pressent a les pràctiques: Documental
 def test_get_sensor_2_data_update():
     """We can get a sensor by its id"""
-    response = client.get("/sensors/2/data")
+    response = wait_for_consumer("/sensors/2/data", lambda json: json["last_seen"] == "2020-01-01T02:00:00.000Z")
     assert response.status_code == 200
     json = response.json()
     assert json["id"] == 2
@@ -236,28 +255,29 @@ def test_get_sensor_2_data_update():
 # Test pressent a les pràctiques: Temporals
 def test_post_sensor_data_veolicitat_week_1():
     response = client.post("/sensors/3/data", json={"velocity": 1.0, "battery_level": 1.0, "last_seen": "2020-01-01T00:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 # Test pressent a les pràctiques: Temporals
 def test_post_sensor_data_veolicitat_week_2():
     response = client.post("/sensors/3/data", json={"velocity": 15.0, "battery_level": 1.0, "last_seen": "2020-01-08T00:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 # Test pressent a les pràctiques: Temporals
 def test_post_sensor_data_veolicitat_week_3():
     response = client.post("/sensors/3/data", json={"velocity": 18.0, "battery_level": 0.9, "last_seen": "2020-01-15T00:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 # Test pressent a les pràctiques: Columnars
 def test_post_sensor_data_veolicitat_2():
     response = client.post("/sensors/3/data", json={"velocity": 15.0, "battery_level": 0.15, "last_seen": "2020-01-01T01:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 # Test pressent a les pràctiques: Columnars
 def test_get_values_sensor_temperatura():
-    response = client.get("/sensors/temperature/values")
+    expected = {"sensors": [{"id": 1, "name": "Sensor Temperatura 1", "latitude": 1.0, "longitude": 1.0, "type": "Temperatura", "mac_address": "00:00:00:00:00:00", "manufacturer": "Dummy", "model":"Dummy Temp", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de temperatura model Dummy Temp del fabricant Dummy", "values": [{"max_temperature": 18.0, "min_temperature": 1.0, "average_temperature": 9.5}]}, {"id": 4, "name": "Sensor Temperatura 2", "latitude": 2.0, "longitude": 2.0, "type": "Temperatura", "mac_address": "00:00:00:00:00:03", "manufacturer": "Dummy", "model":"Dummy Temp", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de temperatura model Dummy Temp del fabricant Dummy", "values": [{"max_temperature": 17.0, "min_temperature": 15.0, "average_temperature": 16.0}]}]}
+    response = wait_for_consumer("/sensors/temperature/values", lambda json: json == expected)
     assert response.status_code == 200
-    assert response.json() == {"sensors": [{"id": 1, "name": "Sensor Temperatura 1", "latitude": 1.0, "longitude": 1.0, "type": "Temperatura", "mac_address": "00:00:00:00:00:00", "manufacturer": "Dummy", "model":"Dummy Temp", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de temperatura model Dummy Temp del fabricant Dummy", "values": [{"max_temperature": 18.0, "min_temperature": 1.0, "average_temperature": 9.5}]}, {"id": 4, "name": "Sensor Temperatura 2", "latitude": 2.0, "longitude": 2.0, "type": "Temperatura", "mac_address": "00:00:00:00:00:03", "manufacturer": "Dummy", "model":"Dummy Temp", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de temperatura model Dummy Temp del fabricant Dummy", "values": [{"max_temperature": 17.0, "min_temperature": 15.0, "average_temperature": 16.0}]}]}
+    assert response.json() == expected
 
 # Test pressent a les pràctiques: Columnars
 def test_get_sensors_quantity():
@@ -267,49 +287,50 @@ def test_get_sensors_quantity():
 
 # Test pressent a les pràctiques: Columnars
 def test_get_sensors_low_battery():
-    response = client.get("/sensors/low_battery")
+    expected = {"sensors": [{"id": 3, "name": "Velocitat 2", "latitude": 2.0, "longitude": 2.0, "type": "Velocitat", "mac_address": "00:00:00:00:00:02", "manufacturer": "Dummy", "model":"Dummy Vel", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de velocitat model Dummy Vel del fabricant Dummy cruïlla 2", "battery_level": 0.15}]}
+    response = wait_for_consumer("/sensors/low_battery", lambda json: json == expected)
     assert response.status_code == 200
-    assert response.json() == {"sensors": [{"id": 2, "name": "Velocitat 1", "latitude": 1.0, "longitude": 1.0, "type": "Velocitat", "mac_address": "00:00:00:00:00:01", "manufacturer": "Dummy", "model":"Dummy Vel", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de velocitat model Dummy Vel del fabricant Dummy cruïlla 1", "battery_level": 0.1}, {"id": 3, "name": "Velocitat 2", "latitude": 2.0, "longitude": 2.0, "type": "Velocitat", "mac_address": "00:00:00:00:00:02", "manufacturer": "Dummy", "model":"Dummy Vel", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de velocitat model Dummy Vel del fabricant Dummy cruïlla 2", "battery_level": 0.15}]}
+    assert response.json() == expected
 
 # Test pressent a les pràctiques: Temporals
 def test_get_sensor_data_1_day():
     """We can get a sensor by its id"""
-    response = client.get("/sensors/1/data?from_=2020-01-01T00:00:00.000Z&to=2020-01-03T00:00:00.000Z&bucket=day")
+    response = wait_for_consumer("/sensors/1/data?from_=2020-01-01T00:00:00.000Z&to=2020-01-03T00:00:00.000Z&bucket=day", lambda json: len(json) == 3)
     assert response.status_code == 200
     json = response.json()
     assert len(json) == 3
 
 # Test pressent a les pràctiques: Temporals
 def test_get_sensor_data_1_week():
-    response = client.get("/sensors/1/data?from_=2020-01-01T00:00:00.000Z&to=2020-01-07T00:00:00.000Z&bucket=week")
+    response = wait_for_consumer("/sensors/1/data?from_=2020-01-01T00:00:00.000Z&to=2020-01-07T00:00:00.000Z&bucket=week", lambda json: len(json) == 1)
     assert response.status_code == 200
     json = response.json()
     assert len(json) == 1
 
 # Test pressent a les pràctiques: Temporals
 def test_get_sensor_data_2_hour():
-    response = client.get("/sensors/2/data?from_=2020-01-01T00:00:00.000Z&to=2020-01-01T02:00:00.000Z&bucket=hour")
+    response = wait_for_consumer("/sensors/2/data?from_=2020-01-01T00:00:00.000Z&to=2020-01-01T02:00:00.000Z&bucket=hour", lambda json: len(json) == 3)
     assert response.status_code == 200
     json = response.json()
     assert len(json) == 3
 
 # Test pressent a les pràctiques: Temporals
 def test_get_sensor_data_2_day():
-    response = client.get("/sensors/2/data?from_=2020-01-01T00:00:00.000Z&to=2020-01-02T00:00:00.000Z&bucket=day")
+    response = wait_for_consumer("/sensors/2/data?from_=2020-01-01T00:00:00.000Z&to=2020-01-02T00:00:00.000Z&bucket=day", lambda json: len(json) == 1)
     assert response.status_code == 200
     json = response.json()
     assert len(json) == 1
 
 # Test pressent a les pràctiques: Temporals
 def test_get_sensor_data_3_week():
-    response = client.get("/sensors/3/data?from_=2020-01-01T00:00:00.000Z&to=2020-01-15T00:00:00.000Z&bucket=week")
+    response = wait_for_consumer("/sensors/3/data?from_=2020-01-01T00:00:00.000Z&to=2020-01-15T00:00:00.000Z&bucket=week", lambda json: len(json) == 3)
     assert response.status_code == 200
     json = response.json()
     assert len(json) == 3
 
 # Test pressent a les pràctiques: Temporals
 def test_get_sensor_data_3_month():
-    response = client.get("/sensors/3/data?from_=2020-01-01T00:00:00.000Z&to=2020-01-31T00:00:00.000Z&bucket=month")
+    response = wait_for_consumer("/sensors/3/data?from_=2020-01-01T00:00:00.000Z&to=2020-01-31T00:00:00.000Z&bucket=month", lambda json: len(json) == 1)
     assert response.status_code == 200
     json = response.json()
     assert len(json) == 1
@@ -362,43 +383,47 @@ def test_elasticsearch_client():
 # Test pressent a les pràctiques: Indexos
 def test_search_sensors_temperatura():
     """Sensors can be properly searched by type"""
-    response = client.get('/sensors/search?query={"type":"Temperatura"}')
+    expected = [{"id": 1, "name": "Sensor Temperatura 1", "latitude": 1.0, "longitude": 1.0, "type": "Temperatura", "mac_address": "00:00:00:00:00:00", "manufacturer": "Dummy", "model": "Dummy Temp", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de temperatura model Dummy Temp del fabricant Dummy"},
+                {"id": 4, "name": "Sensor Temperatura 2", "latitude": 2.0, "longitude": 2.0, "type": "Temperatura", "mac_address": "00:00:00:00:00:03", "manufacturer": "Dummy", "model":"Dummy Temp", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de temperatura model Dummy Temp del fabricant Dummy"}]
+    response = wait_for_consumer('/sensors/search?query={"type":"Temperatura"}', lambda json: json == expected)
     assert response.status_code == 200
-    assert response.json() == [{"id": 1, "name": "Sensor Temperatura 1", "latitude": 1.0, "longitude": 1.0, "type": "Temperatura", "mac_address": "00:00:00:00:00:00", "manufacturer": "Dummy", "model": "Dummy Temp", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de temperatura model Dummy Temp del fabricant Dummy"},
-                               {"id": 4, "name": "Sensor Temperatura 2", "latitude": 2.0, "longitude": 2.0, "type": "Temperatura", "mac_address": "00:00:00:00:00:03", "manufacturer": "Dummy", "model":"Dummy Temp", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de temperatura model Dummy Temp del fabricant Dummy"}]
+    assert response.json() == expected
 
 # Test pressent a les pràctiques: Indexos
 def test_search_sensors_name_similar():
     """Sensors can be properly searched by name"""
-    response = client.get('/sensors/search?query={"name":"Velocidad 1"}&search_type=similar')
+    expected = [{"id": 2, "name": "Velocitat 1", "latitude": 1.0, "longitude": 1.0, "type": "Velocitat", "mac_address": "00:00:00:00:00:01", "manufacturer": "Dummy", "model": "Dummy Vel", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de velocitat model Dummy Vel del fabricant Dummy cruïlla 1"}]
+    response = wait_for_consumer('/sensors/search?query={"name":"Velocidad 1"}&search_type=similar', lambda json: json == expected)
     assert response.status_code == 200
-    assert response.json() == [{"id": 2, "name": "Velocitat 1", "latitude": 1.0, "longitude": 1.0, "type": "Velocitat", "mac_address": "00:00:00:00:00:01", "manufacturer": "Dummy", "model": "Dummy Vel", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de velocitat model Dummy Vel del fabricant Dummy cruïlla 1"}]
+    assert response.json() == expected
 
 # Test pressent a les pràctiques: Indexos
 def test_search_sensors_name_prefix():
     """Sensors can be properly searched by name"""
-    response = client.get('/sensors/search?query={"name":"Veloci"}&search_type=prefix')
-    assert response.status_code == 200
-    assert response.json() == [
+    expected = [
         {"id": 2, "name": "Velocitat 1", "latitude": 1.0, "longitude": 1.0, "type": "Velocitat", "mac_address": "00:00:00:00:00:01", "manufacturer": "Dummy", "model": "Dummy Vel", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de velocitat model Dummy Vel del fabricant Dummy cruïlla 1"},
         {"id": 3, "name": "Velocitat 2", "latitude": 2.0, "longitude": 2.0, "type": "Velocitat", "mac_address": "00:00:00:00:00:02", "manufacturer": "Dummy", "model": "Dummy Vel", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de velocitat model Dummy Vel del fabricant Dummy cruïlla 2"}]
+    response = wait_for_consumer('/sensors/search?query={"name":"Veloci"}&search_type=prefix', lambda json: json == expected)
+    assert response.status_code == 200
+    assert response.json() == expected
     
 # Test pressent a les pràctiques: Indexos
 def test_search_sensors_type_limit():
     """Sensors can be properly searched by type"""
-    response = client.get('/sensors/search?query={"type":"Velocitat"}&size=1')
+    response = wait_for_consumer('/sensors/search?query={"type":"Velocitat"}&size=1', lambda json: len(json) == 1)
     assert response.status_code == 200
     assert len(response.json()) == 1
 
 # Test pressent a les pràctiques: Indexos
 def test_search_sensors_description_similar():
     """Sensors can be properly searched by description"""
-    response = client.get('/sensors/search?query={"description":"dummy"}&search_type=similar')
-    assert response.status_code == 200
-    assert response.json() == [{"id": 1, "name": "Sensor Temperatura 1", "latitude": 1.0, "longitude": 1.0, "type": "Temperatura", "mac_address": "00:00:00:00:00:00", "manufacturer": "Dummy", "model": "Dummy Temp", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de temperatura model Dummy Temp del fabricant Dummy"},
+    expected = [{"id": 1, "name": "Sensor Temperatura 1", "latitude": 1.0, "longitude": 1.0, "type": "Temperatura", "mac_address": "00:00:00:00:00:00", "manufacturer": "Dummy", "model": "Dummy Temp", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de temperatura model Dummy Temp del fabricant Dummy"},
         {"id": 4, "name": "Sensor Temperatura 2", "latitude": 2.0, "longitude": 2.0, "type": "Temperatura", "mac_address": "00:00:00:00:00:03", "manufacturer": "Dummy", "model":"Dummy Temp", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de temperatura model Dummy Temp del fabricant Dummy"},
         {"id": 2, "name": "Velocitat 1", "latitude": 1.0, "longitude": 1.0, "type": "Velocitat", "mac_address": "00:00:00:00:00:01", "manufacturer": "Dummy", "model": "Dummy Vel", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de velocitat model Dummy Vel del fabricant Dummy cruïlla 1"},
-        {"id": 3, "name": "Velocitat 2", "latitude": 2.0, "longitude": 2.0, "type": "Velocitat", "mac_address": "00:00:00:00:00:02", "manufacturer": "Dummy", "model": "Dummy Vel", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de velocitat model Dummy Vel del fabricant Dummy cruïlla 2"}]  
+        {"id": 3, "name": "Velocitat 2", "latitude": 2.0, "longitude": 2.0, "type": "Velocitat", "mac_address": "00:00:00:00:00:02", "manufacturer": "Dummy", "model": "Dummy Vel", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de velocitat model Dummy Vel del fabricant Dummy cruïlla 2"}]
+    response = wait_for_consumer('/sensors/search?query={"description":"dummy"}&search_type=similar', lambda json: json == expected)
+    assert response.status_code == 200
+    assert response.json() == expected
     
 # Test pressent a les pràctiques: Documental
 def test_get_near():
@@ -417,6 +442,11 @@ def test_get_near():
     assert json[1]["battery_level"] == 0.9
     assert json[1]["last_seen"] == "2020-01-01T02:00:00.000Z"
 
+def test_get_near_limit_out_of_range():
+    for limit in (0, -1):
+        response = client.get(f"/sensors/near?latitude=1.0&longitude=1.0&radius=1&limit={limit}")
+        assert response.status_code == 422
+
 # Test pressent a les pràctiques: Documental
 def test_delete_sensor_1():
     response = client.delete("/sensors/1")
@@ -425,4 +455,26 @@ def test_delete_sensor_1():
 # Test pressent a les pràctiques: Documental
 def test_delete_sensor_2():
     response = client.delete("/sensors/2")
-    assert response.status_code == 200
\ No newline at end of file
+    assert response.status_code == 200
+
+def test_post_sensor_data_batch():
+    response = client.post("/sensors/data/batch", json=[
+        {"sensor_id": 3, "velocity": 10.0, "battery_level": 0.5, "last_seen": "2020-01-02T00:00:00.000Z"},
+        {"sensor_id": 1, "velocity": 10.0, "battery_level": 0.5, "last_seen": "2020-01-02T00:00:00.000Z"},
+        {"sensor_id": 3, "velocity": 10.0}])
+    assert response.status_code == 200
+    json = response.json()
+    assert json["accepted"] == 1
+    assert json["rejected"] == 2
+    assert [item["status"] for item in json["items"]] == [202, 404, 422]
+
+def test_post_sensor_data_batch_ndjson():
+    body = '{"sensor_id": 3, "velocity": 11.0, "battery_level": 0.5, "last_seen": "2020-01-02T01:00:00.000Z"}\nnot json\n'
+    response = client.post("/sensors/data/batch", content=body, headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert [item["status"] for item in response.json()["items"]] == [202, 422]
+
+def test_metrics():
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
@@ -0,0 +1,67 @@
+import time
+
+import fastapi
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+
+from app import timing
+
+
+class FakeRedis:
+    def get(self, key):
+        time.sleep(0.001)
+        return key
+
+    def pipeline(self, transaction=True):
+        return FakePipeline()
+
+
+class FakePipeline:
+    def hgetall(self, key):
+        pass
+
+    def execute(self):
+        return []
+
+
+class FakeMongo:
+    def getDatabase(self, name):
+        return name
+
+
+def test_server_timing_and_metrics(monkeypatch):
+    monkeypatch.setattr(timing, "ENABLED", True)
+    redis = timing.instrument('redis', FakeRedis())
+    mongodb = timing.instrument('mongodb', FakeMongo())
+    assert mongodb.__class__ is FakeMongo
+
+    app = fastapi.FastAPI()
+
+    @app.get("/things/{thing_id}")
+    def get_thing(thing_id: int):
+        mongodb.getDatabase("mydatabase")
+        redis.get(thing_id)
+        pipe = redis.pipeline(transaction=False)
+        pipe.hgetall(thing_id)
+        pipe.execute()
+        return {}
+
+    @app.get("/metrics")
+    def metrics():
+        return fastapi.responses.PlainTextResponse(timing.render())
+
+    timing.install(app, create_engine("sqlite://"))
+    client = TestClient(app)
+
+    response = client.get("/things/1")
+    assert response.status_code == 200
+    server_timing = response.headers["Server-Timing"]
+    # get and the pipeline's execute, neither the buffered hgetall nor mongo
+    assert 'redis;dur=' in server_timing
+    assert 'desc="2 calls"' in server_timing
+    assert 'mongodb' not in server_timing
+    assert 'total;dur=' in server_timing
+
+    body = client.get("/metrics").text
+    assert 'api_backend_calls_total{route="/things/{thing_id}",backend="redis"} 2' in body
+    assert 'api_request_seconds_count{route="/things/{thing_id}",method="GET",status="200"} 1' in body
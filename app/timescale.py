@@ -1,45 +1,84 @@
 import psycopg2
+import psycopg2.pool
 import os
+import threading
+from yoyo import get_backend, read_migrations
+
+MIGRATIONS_DIR = 'migrations_ts'
+POOL_MIN = int(os.environ.get("TS_POOL_MIN", 1))
+POOL_MAX = int(os.environ.get("TS_POOL_MAX", 20))
+
+
+def connection_params():
+    return dict(
+        host=os.environ.get("TS_HOST"),
+        port=os.environ.get("TS_PORT"),
+        user=os.environ.get("TS_USER"),
+        password=os.environ.get("TS_PASSWORD"),
+        database=os.environ.get("TS_DBNAME"))
+
+
+def migrate():
+    # Run once when the API starts. yoyo records the applied migrations in
+    # the database, so only the files that are new since the last start run.
+    params = connection_params()
+    database = params['database'] or params['user']
+    backend = get_backend(f"postgresql://{params['user']}:{params['password']}@{params['host']}:{params['port']}/{database}")
+    migrations = read_migrations(MIGRATIONS_DIR)
+    with backend.lock():
+        backend.apply_migrations(backend.to_apply(migrations))
+
+
+_pool = None
+_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises when it runs out of connections, the
+# semaphore makes requests wait for a free one instead
+_slots = threading.BoundedSemaphore(POOL_MAX)
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = psycopg2.pool.ThreadedConnectionPool(POOL_MIN, POOL_MAX, **connection_params())
+    return _pool
 
 
 class Timescale:
     def __init__(self):
-        self.conn = psycopg2.connect(
-            host=os.environ.get("TS_HOST"),
-            port=os.environ.get("TS_PORT"),
-            user=os.environ.get("TS_USER"),
-            password=os.environ.get("TS_PASSWORD"),
-            database=os.environ.get("TS_DBNAME"))
+        self.pool = get_pool()
+        _slots.acquire()
+        try:
+            self.conn = self.pool.getconn()
+        except Exception:
+            _slots.release()
+            raise
         self.conn.autocommit = True
         self.cursor = self.conn.cursor()
-        
-        with open('migrations_ts/migrations_ts.sql', 'r') as file:
-            sql_statements = file.read().split(';')
-    
-        for statement in sql_statements:
-            if statement.strip():
-                self.cursor.execute(statement)
 
     def getCursor(self):
             return self.cursor
 
     def close(self):
         self.cursor.close()
-        self.conn.close()
-    
+        # A connection that broke while borrowed is dropped, not pooled again
+        self.pool.putconn(self.conn, close=bool(self.conn.closed))
+        _slots.release()
+
     def ping(self):
         return self.conn.ping()
-    
+
     def execute(self, query, params=None):
         if params:
             return self.cursor.execute(query, params)
         else:
             return self.cursor.execute(query)
-    
+
     def delete(self, table):
         self.cursor.execute("DELETE FROM " + table)
         self.conn.commit()
 
-        
-     
-         
\ No newline at end of file
+
+
+
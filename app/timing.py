@@ -0,0 +1,162 @@
+import contextvars
+import os
+import time
+
+import pymongo.monitoring
+from sqlalchemy import event
+
+from shared import metrics
+
+# Per request timing of the calls to each backend, reported in a
+# Server-Timing header and in per-route histograms on /metrics. Only when
+# BACKEND_TIMING is on: otherwise the registry hands out the plain clients
+# and no middleware or listener is installed, so it costs nothing.
+ENABLED = os.environ.get("BACKEND_TIMING", "").lower() in ("1", "true", "yes")
+
+REGISTRY = metrics.Registry()
+REQUEST_SECONDS = REGISTRY.histogram('api_request_seconds', 'Time to answer a request', ['route', 'method', 'status'])
+BACKEND_SECONDS = REGISTRY.histogram('api_backend_seconds', 'Time a request spent waiting for a backend',
+                                     ['route', 'backend'])
+BACKEND_CALLS = REGISTRY.counter('api_backend_calls_total', 'Calls made to a backend', ['route', 'backend'])
+
+# The (backend, seconds) of the calls made by the current request. The list
+# is shared with the threads the request runs its sync code on, which get a
+# copy of the context.
+_calls = contextvars.ContextVar('backend_calls', default=None)
+
+
+def record(backend, seconds):
+    calls = _calls.get()
+    if calls is not None:
+        calls.append((backend, seconds))
+
+
+class Timed:
+    # Proxy that times the method calls of the wrapped client, all of them or
+    # only those in `only`. The wrapped methods are cached on the proxy, so
+    # only the first lookup of each goes through __getattr__. Methods in
+    # `nested` return objects that reach the backend later (a redis
+    # pipeline), those are wrapped too with their own `only`.
+
+    def __init__(self, backend, client, only=None, nested=None):
+        object.__setattr__(self, '_backend', backend)
+        object.__setattr__(self, '_client', client)
+        object.__setattr__(self, '_only', only)
+        object.__setattr__(self, '_nested', nested or {})
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+        backend = self._backend
+        if name in self._nested:
+            only = self._nested[name]
+
+            def method(*args, **kwargs):
+                return Timed(backend, attr(*args, **kwargs), only)
+        elif self._only is not None and name not in self._only:
+            method = attr
+        else:
+            def method(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return attr(*args, **kwargs)
+                finally:
+                    record(backend, time.perf_counter() - start)
+        object.__setattr__(self, name, method)
+        return method
+
+    def __setattr__(self, name, value):
+        setattr(self._client, name, value)
+
+    def __enter__(self):
+        self._client.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._client.__exit__(*exc_info)
+
+
+# Methods that reach the backend, when not all of them do
+ONLY = {
+    'timescale': ('execute',),
+}
+NESTED = {
+    'redis': {'pipeline': ('execute',)},
+}
+
+
+def instrument(backend, client):
+    # The client itself when timing is off. Mongo is never proxied, its
+    # commands are timed by _MongoListener and getDatabase/getCollection
+    # would otherwise count as calls of their own.
+    if not ENABLED or backend == 'mongodb':
+        return client
+    return Timed(backend, client, ONLY.get(backend), NESTED.get(backend))
+
+
+class _MongoListener(pymongo.monitoring.CommandListener):
+    # pymongo reports every command with its duration, in the thread that
+    # ran it. The repository works on raw collections, so this is where
+    # mongo calls are seen.
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        record('mongodb', event.duration_micros / 1e6)
+
+    def failed(self, event):
+        record('mongodb', event.duration_micros / 1e6)
+
+
+def install(app, engine):
+    # Adds the middleware and the mongo and postgres hooks. Must run before
+    # the mongo client is created.
+    if not ENABLED:
+        return
+    pymongo.monitoring.register(_MongoListener())
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        record('postgres', time.perf_counter() - conn.info['query_start'].pop())
+
+    app.middleware("http")(middleware)
+
+
+async def middleware(request, call_next):
+    calls = []
+    token = _calls.set(calls)
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        _calls.reset(token)
+    elapsed = time.perf_counter() - start
+
+    totals = {}
+    for backend, seconds in calls:
+        count, total = totals.get(backend, (0, 0.0))
+        totals[backend] = (count + 1, total + seconds)
+
+    # The route template, so /sensors/1/data and /sensors/2/data are one
+    # series. Requests that matched no route share one too.
+    route = request.scope.get('route')
+    path = route.path if route is not None else 'unmatched'
+    REQUEST_SECONDS.labels(path, request.method, response.status_code).observe(elapsed)
+    timings = []
+    for backend, (count, total) in totals.items():
+        BACKEND_SECONDS.labels(path, backend).observe(total)
+        BACKEND_CALLS.labels(path, backend).inc(count)
+        timings.append(f'{backend};dur={total * 1000:.2f};desc="{count} calls"')
+    timings.append(f'total;dur={elapsed * 1000:.2f}')
+    response.headers['Server-Timing'] = ", ".join(timings)
+    return response
+
+
+def render():
+    return metrics.render([({}, REGISTRY.snapshot())])
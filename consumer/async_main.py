@@ -0,0 +1,61 @@
+import asyncio
+import os
+import signal
+import sys
+
+from consumer import metrics
+from consumer.async_sinks import ASYNC_SINKS
+from consumer.main import QUEUES, Instrumented
+from shared.async_subscriber import MAX_IN_FLIGHT, AsyncSubscriber
+from shared.dedupe import AsyncDeduplicator
+from shared.sensors.schemas import SensorDataMessage
+
+
+async def run(sink_names, metrics_channel=None, worker=0):
+    # One event loop can serve several sink queues, each with its own batches
+    sinks = {name: ASYNC_SINKS[name]() for name in sink_names}
+    dedupes = {name: AsyncDeduplicator(QUEUES[name]) for name, sink in sinks.items()
+               if sink.schema is SensorDataMessage}
+    await asyncio.gather(*(sink.connect() for sink in sinks.values()))
+    if metrics_channel is not None:
+        metrics.push(metrics_channel, worker)
+
+    subscriber = AsyncSubscriber()
+    await subscriber.connect()
+
+    batchers = []
+    instrumented = {}
+    for name, sink in sinks.items():
+        batches = instrumented[name] = Instrumented(name, sink, dedupes.get(name), slots=MAX_IN_FLIGHT)
+        batchers.append(await subscriber.subscribe_batch(QUEUES[name], batches.on_batch_async))
+
+    async def poll_depths():
+        while True:
+            await asyncio.sleep(metrics.DEPTH_INTERVAL)
+            for name, batches in instrumented.items():
+                result = await subscriber.queues[QUEUES[name]].declare()
+                batches.stats.depth(result.message_count)
+
+    depths = asyncio.create_task(poll_depths())
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    await stop.wait()
+
+    # Stop receiving, then write and ack whatever is still buffered
+    depths.cancel()
+    for name, (batcher, tag) in zip(sinks, batchers):
+        await subscriber.queues[QUEUES[name]].cancel(tag)
+        await batcher.drain()
+    await subscriber.close()
+    await asyncio.gather(*(sink.close() for sink in sinks.values()),
+                         *(dedupe.close() for dedupe in dedupes.values()))
+
+
+if __name__ == "__main__":
+    # python consumer/async_main.py <redis|timescale|cassandra>...
+    names = sys.argv[1:] or os.environ["CONSUMER_SINK"].split(",")
+    metrics.serve(names[0])
+    asyncio.run(run(names))
@@ -0,0 +1,131 @@
+import asyncio
+import os
+
+import asyncpg
+import redis.asyncio
+
+from consumer.sinks import LOW_BATTERY_KEY, UNTRACK_SCRIPT, CassandraSink, RedisSink, TimescaleSink
+from shared.cassandra_client import CassandraClient
+from shared.cassandra_schema import create_schema
+from shared import temperature_stats
+
+# asyncio versions of the sinks in consumer/sinks.py. They build the same
+# rows and statements but never block the event loop while the database
+# answers, so several batches can be written at the same time.
+
+
+class AsyncRedisSink(RedisSink):
+    def __init__(self):
+        self.redis = redis.asyncio.Redis(host=os.environ.get("REDIS_HOST", "redis"))
+        self.update_stats = self.redis.register_script(temperature_stats.UPDATE_SCRIPT)
+
+    async def connect(self):
+        pass
+
+    async def write(self, messages):
+        pipe = self.redis.pipeline()
+        pipe.mset(self.latest(messages))
+        await temperature_stats.update_async(self.update_stats, pipe, temperature_stats.aggregate(messages))
+        await pipe.execute()
+
+    async def close(self):
+        await self.redis.close()
+
+
+class AsyncTimescaleSink(TimescaleSink):
+    query = """
+        INSERT INTO sensor_data (id, velocity, temperature, humidity, battery_level, last_seen)
+        VALUES ($1, $2, $3, $4, $5, $6::text::timestamp)
+        ON CONFLICT (id, last_seen) DO NOTHING
+    """
+
+    def __init__(self):
+        self.pool = None
+
+    async def connect(self):
+        self.pool = await asyncpg.create_pool(
+            host=os.environ.get("TS_HOST"),
+            port=os.environ.get("TS_PORT"),
+            user=os.environ.get("TS_USER"),
+            password=os.environ.get("TS_PASSWORD"),
+            database=os.environ.get("TS_DBNAME"),
+            max_size=int(os.environ.get("CONSUMER_MAX_IN_FLIGHT", 4)))
+
+    async def write(self, messages):
+        async with self.pool.acquire() as conn:
+            await conn.executemany(self.query, self.rows(messages))
+
+    async def close(self):
+        await self.pool.close()
+
+
+class AsyncCassandraSink(CassandraSink):
+    def __init__(self):
+        self.cassandra = None
+        self.battery = self.battery_delete = None
+        self.redis = redis.asyncio.Redis(host=os.environ.get("REDIS_HOST", "redis"))
+        self.untrack = self.redis.register_script(UNTRACK_SCRIPT)
+
+    async def connect(self):
+        # Connecting blocks, so it runs in a thread
+        host = os.environ.get("CASSANDRA_HOST", "cassandra")
+        self.cassandra = await asyncio.to_thread(CassandraClient, hosts=[host])
+        await asyncio.to_thread(create_schema, self.cassandra)
+        # Preparing is a blocking round trip too. The client caches the
+        # statements, so partition_batches in write() finds the temperature
+        # one ready.
+        self.battery = await asyncio.to_thread(self.cassandra.prepare, self.battery_query)
+        self.battery_delete = await asyncio.to_thread(self.cassandra.prepare, self.battery_delete_query)
+        await asyncio.to_thread(self.cassandra.prepare, self.temperature_query)
+        if not await self.redis.exists(LOW_BATTERY_KEY):
+            rows = await asyncio.to_thread(lambda: list(self.cassandra.execute(self.seed_query)))
+            if rows:
+                await self.redis.zadd(LOW_BATTERY_KEY, {row.id: row.written for row in rows}, gt=True)
+
+    def execute(self, statement, params=None):
+        # Wraps the driver's ResponseFuture, whose callbacks run on the
+        # driver's own threads, into an asyncio future
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        response = self.cassandra.get_session().execute_async(statement, params)
+        response.add_callbacks(
+            lambda result: loop.call_soon_threadsafe(_set_result, future, result),
+            lambda error: loop.call_soon_threadsafe(_set_exception, future, error))
+        return future
+
+    async def write(self, messages):
+        timestamp = self.write_timestamp()
+        low, healthy = self.battery_rows(messages, timestamp)
+        recovered = []
+        if low:
+            await self.redis.zadd(LOW_BATTERY_KEY, {row[0]: timestamp for row in low}, gt=True)
+        if healthy:
+            recovered = self.recovered(healthy, await self.redis.zmscore(LOW_BATTERY_KEY, healthy), timestamp)
+        writes = [self.execute(self.battery, row) for row in low]
+        writes += [self.execute(self.battery_delete, (timestamp, sensor_id)) for sensor_id in recovered]
+        batches = self.cassandra.partition_batches(self.temperature_query, self.temperature_rows(messages), self.temperature_partition)
+        writes += [self.execute(batch) for batch in batches]
+        await asyncio.gather(*writes)
+        if recovered:
+            await self.untrack(keys=[LOW_BATTERY_KEY], args=[timestamp, *recovered])
+
+    async def close(self):
+        await asyncio.to_thread(self.cassandra.close)
+        await self.redis.close()
+
+
+def _set_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future, error):
+    if not future.done():
+        future.set_exception(error)
+
+
+ASYNC_SINKS = {
+    'redis': AsyncRedisSink,
+    'timescale': AsyncTimescaleSink,
+    'cassandra': AsyncCassandraSink,
+}
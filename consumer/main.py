@@ -1,13 +1,125 @@
-import json
+import contextlib
+import os
+import sys
+import time
 
+from consumer import metrics
+from consumer.sinks import SINKS
+from shared import codec
+from shared.dedupe import Deduplicator
+from shared.publisher import EVENT_QUEUES, SINK_QUEUES
+from shared.sensors.schemas import SensorDataMessage
 from shared.subscriber import Subscriber
 
-subscriber = Subscriber()
+# Readings sinks and sensor event sinks are started the same way
+QUEUES = {**SINK_QUEUES, **EVENT_QUEUES}
 
 
-def callback(ch, method, properties, body):
-    data = json.loads(body)
-    print("Received data:", data)
+def parse(deliveries, schema=SensorDataMessage, invalid=None):
+    # deliveries are shared.subscriber.Delivery. A reading message may hold
+    # many readings, in JSON or msgpack (shared/codec.py). Malformed messages
+    # would fail every retry, so they are dropped and counted in `invalid`.
+    messages = []
+    dropped = 0
+    for delivery in deliveries:
+        try:
+            if schema is SensorDataMessage:
+                messages += codec.decode(delivery.body, delivery.content_type)
+            else:
+                messages.append(schema.parse_raw(delivery.body))
+        except ValueError as e:
+            if not dropped:
+                print("Discarding invalid message:", delivery.body[:200], e)
+            dropped += 1
+    if dropped and invalid is not None:
+        invalid.inc(dropped)
+    return messages
 
 
-subscriber.subscribe(callback)
+class Instrumented:
+    # Wraps the write of a batch (dedupe, parse, write, mark) with the
+    # metrics of the sink. on_batch and on_batch_async only differ in the
+    # awaits, the accounting is shared.
+
+    def __init__(self, sink_name, sink, dedupe, slots=1):
+        self.sink = sink
+        self.dedupe = dedupe
+        self.stats = metrics.SinkMetrics(sink_name, QUEUES[sink_name], slots)
+
+    @contextlib.contextmanager
+    def _flush(self, deliveries, split):
+        # Counts the batch and times it, as failed if the body raises. The
+        # parts of a failed batch that are written again (split) were
+        # already received.
+        if not split:
+            self.stats.received(len(deliveries))
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.stats.flushed(len(deliveries), time.perf_counter() - start, False)
+            raise
+        self.stats.flushed(len(deliveries), time.perf_counter() - start, True)
+
+    def _parse(self, deliveries, fresh):
+        # fresh is what is left of deliveries after dropping duplicates
+        if len(fresh) != len(deliveries):
+            self.stats.duplicates.inc(len(deliveries) - len(fresh))
+        return parse(fresh, self.sink.schema, self.stats.invalid)
+
+    def on_batch(self, deliveries, split=False):
+        with self._flush(deliveries, split):
+            fresh = self.dedupe.unseen(deliveries) if self.dedupe else deliveries
+            messages = self._parse(deliveries, fresh)
+            if messages:
+                self.sink.write(messages)
+                self.stats.written.inc(len(messages))
+            if self.dedupe:
+                self.dedupe.mark(fresh)
+
+    async def on_batch_async(self, deliveries, split=False):
+        with self._flush(deliveries, split):
+            fresh = await self.dedupe.unseen(deliveries) if self.dedupe else deliveries
+            messages = self._parse(deliveries, fresh)
+            if messages:
+                await self.sink.write(messages)
+                self.stats.written.inc(len(messages))
+            if self.dedupe:
+                await self.dedupe.mark(fresh)
+
+
+def run(sink_name, metrics_channel=None, worker=0):
+    # Each sink has its own queue, so every database gets its own group of
+    # consumers that can be scaled and tuned (batch size, prefetch) apart.
+    # The metrics go to the supervisor through metrics_channel, or are
+    # served here when the consumer runs on its own.
+    sink = SINKS[sink_name]()
+    queue = QUEUES[sink_name]
+    # Sensor events are applied as upserts and deletes, replaying them is
+    # harmless. Readings are deduplicated by message id.
+    dedupe = Deduplicator(queue) if sink.schema is SensorDataMessage else None
+    batches = Instrumented(sink_name, sink, dedupe)
+    if metrics_channel is not None:
+        metrics.push(metrics_channel, worker)
+
+    subscriber = Subscriber()
+
+    def poll_depth():
+        batches.stats.depth(subscriber.queue_depth(queue))
+        subscriber.conn.call_later(metrics.DEPTH_INTERVAL, poll_depth)
+
+    subscriber.conn.call_later(metrics.DEPTH_INTERVAL, poll_depth)
+    try:
+        subscriber.subscribe_batch(queue, batches.on_batch)
+    finally:
+        subscriber.close()
+        sink.close()
+        if dedupe:
+            dedupe.close()
+
+
+if __name__ == "__main__":
+    # python consumer/main.py <redis|timescale|cassandra|elasticsearch>
+    name = sys.argv[1] if len(sys.argv) > 1 else os.environ["CONSUMER_SINK"]
+    metrics.serve(name)
+    run(name)
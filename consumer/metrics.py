@@ -0,0 +1,101 @@
+import os
+import threading
+import time
+
+from shared import metrics
+
+# What the consumers report on /metrics. Each worker process keeps its own
+# registry and sends a snapshot of it to its supervisor every PUSH_INTERVAL
+# seconds, the supervisor serves them all labelled by worker.
+
+# Default port per sink, so the supervisors of every sink can run on one host
+PORTS = {'redis': 9101, 'timescale': 9102, 'cassandra': 9103, 'elasticsearch': 9104}
+PUSH_INTERVAL = float(os.environ.get("CONSUMER_METRICS_INTERVAL", 5))
+# Seconds between reads of the queue depth
+DEPTH_INTERVAL = float(os.environ.get("CONSUMER_DEPTH_INTERVAL", 5))
+
+BATCH_SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+REGISTRY = metrics.Registry()
+CONSUMED = REGISTRY.counter('consumer_messages_consumed_total', 'Messages received from the sink queue', ['sink'])
+ACKED = REGISTRY.counter('consumer_messages_acked_total', 'Messages written and acked', ['sink'])
+FAILED = REGISTRY.counter('consumer_messages_failed_total',
+                          'Messages of batches, or parts of them written again, that failed to be written', ['sink'])
+DUPLICATES = REGISTRY.counter('consumer_messages_duplicate_total', 'Messages skipped because they were already written',
+                              ['sink'])
+INVALID = REGISTRY.counter('consumer_messages_invalid_total', 'Messages or readings dropped as invalid', ['sink'])
+WRITTEN = REGISTRY.counter('consumer_records_written_total', 'Readings or events written to the sink', ['sink'])
+BATCH_SIZE = REGISTRY.gauge('consumer_batch_size', 'Messages in the last batch flushed', ['sink'])
+BATCH_SIZES = REGISTRY.histogram('consumer_batch_messages', 'Messages per batch flushed', ['sink'],
+                                 buckets=BATCH_SIZE_BUCKETS)
+FLUSH_SECONDS = REGISTRY.histogram('consumer_flush_seconds', 'Time to write a batch to the sink', ['sink'])
+BUSY_SECONDS = REGISTRY.counter('consumer_busy_seconds_total', 'Time spent writing batches', ['sink'])
+UTILISATION = REGISTRY.gauge('consumer_utilisation',
+                             'Share of the last depth interval spent writing, per write slot', ['sink'])
+QUEUE_DEPTH = REGISTRY.gauge('consumer_queue_depth', 'Ready messages in the sink queue', ['queue'])
+
+
+def port(sink_name):
+    return int(os.environ.get("CONSUMER_METRICS_PORT", PORTS.get(sink_name, 9100)))
+
+
+class SinkMetrics:
+    # The children of one sink, looked up once
+
+    def __init__(self, sink_name, queue, slots=1):
+        self.consumed = CONSUMED.labels(sink_name)
+        self.acked = ACKED.labels(sink_name)
+        self.failed = FAILED.labels(sink_name)
+        self.duplicates = DUPLICATES.labels(sink_name)
+        self.invalid = INVALID.labels(sink_name)
+        self.written = WRITTEN.labels(sink_name)
+        self.batch_size = BATCH_SIZE.labels(sink_name)
+        self.batch_sizes = BATCH_SIZES.labels(sink_name)
+        self.flush_seconds = FLUSH_SECONDS.labels(sink_name)
+        self.busy_seconds = BUSY_SECONDS.labels(sink_name)
+        self.utilisation = UTILISATION.labels(sink_name)
+        self.queue_depth = QUEUE_DEPTH.labels(queue)
+        # Batches that can be written at the same time
+        self.slots = slots
+        self._busy = 0.0
+        self._since = time.monotonic()
+
+    def received(self, count):
+        self.consumed.inc(count)
+        self.batch_size.set(count)
+        self.batch_sizes.observe(count)
+
+    def flushed(self, count, seconds, ok):
+        self.flush_seconds.observe(seconds)
+        self.busy_seconds.inc(seconds)
+        self._busy += seconds
+        if ok:
+            self.acked.inc(count)
+        else:
+            self.failed.inc(count)
+
+    def depth(self, count):
+        # Called every DEPTH_INTERVAL, which also closes a utilisation window
+        self.queue_depth.set(count)
+        now = time.monotonic()
+        if now > self._since:
+            self.utilisation.set(min(1.0, self._busy / (now - self._since) / self.slots))
+        self._busy, self._since = 0.0, now
+
+
+def push(channel, worker):
+    # Sends (worker, snapshot) to the supervisor from a daemon thread. A
+    # worker that exits does not wait for its last snapshot to go through.
+    channel.cancel_join_thread()
+
+    def loop():
+        while True:
+            time.sleep(PUSH_INTERVAL)
+            channel.put((worker, REGISTRY.snapshot()))
+
+    threading.Thread(target=loop, name="metrics-push", daemon=True).start()
+
+
+def serve(sink_name):
+    # For a worker started without a supervisor
+    return metrics.serve(port(sink_name), lambda: metrics.render([({}, REGISTRY.snapshot())]))
@@ -0,0 +1,240 @@
+import json
+import os
+import time
+from datetime import datetime
+from decimal import Decimal
+
+from consumer.metrics import INVALID
+from shared.cassandra_client import CassandraClient
+from shared.elasticsearch_client import ElasticsearchClient
+from shared import search_index
+from shared.cassandra_schema import create_schema, month_of, value_id
+from shared import temperature_stats
+from shared.redis_client import RedisClient
+from shared.sensors.schemas import SensorDataMessage, SensorEvent
+from shared.timescale import Timescale
+
+# Sensors below this battery level are listed in sensor.battery
+LOW_BATTERY_THRESHOLD = float(os.environ.get("LOW_BATTERY_THRESHOLD", 0.2))
+# Redis sorted set of the sensors that may be in sensor.battery, scored by
+# the write timestamp of their last upsert. Only these are deleted when they
+# recover, so healthy sensors leave no tombstones.
+LOW_BATTERY_KEY = "battery:low_at"
+# Takes sensors out of LOW_BATTERY_KEY after their delete, ARGV being the
+# delete's write timestamp and the sensor ids. A sensor upserted after that
+# timestamp by another batch is still in the table and stays.
+UNTRACK_SCRIPT = """
+local removed = 0
+for i = 2, #ARGV do
+    local written = redis.call('ZSCORE', KEYS[1], ARGV[i])
+    if written and tonumber(written) <= tonumber(ARGV[1]) then
+        removed = removed + redis.call('ZREM', KEYS[1], ARGV[i])
+    end
+end
+return removed
+"""
+
+# The sinks split each batch into the rows or statements their database
+# needs (shared with the asyncio sinks in consumer/async_sinks.py) and then
+# write them in as few round trips as possible.
+
+
+class RedisSink:
+    schema = SensorDataMessage
+
+    def __init__(self):
+        self.redis = RedisClient(host=os.environ.get("REDIS_HOST", "redis"))
+        self.update_stats = self.redis.register_script(temperature_stats.UPDATE_SCRIPT)
+
+    @staticmethod
+    def latest(messages):
+        # Only the last reading of each sensor survives in redis, so the
+        # batch is collapsed to one key per sensor and sent in one MSET
+        latest = {}
+        for message in messages:
+            latest[message.sensor_id] = json.dumps(message.reading().dict())
+        return latest
+
+    def write(self, messages):
+        # The latest readings and the temperature stats of the batch are
+        # applied together in one MULTI
+        pipe = self.redis.pipeline()
+        pipe.mset(self.latest(messages))
+        temperature_stats.update(self.update_stats, pipe, temperature_stats.aggregate(messages))
+        pipe.execute()
+
+    def close(self):
+        self.redis.close()
+
+
+class TimescaleSink:
+    schema = SensorDataMessage
+    query = """
+        INSERT INTO sensor_data (id, velocity, temperature, humidity, battery_level, last_seen)
+        VALUES %s
+        ON CONFLICT (id, last_seen) DO NOTHING
+    """
+
+    def __init__(self):
+        self.timescale = Timescale()
+
+    @staticmethod
+    def rows(messages):
+        return [(m.sensor_id, m.velocity, m.temperature, m.humidity, m.battery_level, m.last_seen) for m in messages]
+
+    def write(self, messages):
+        self.timescale.execute_values(self.query, self.rows(messages))
+
+    def close(self):
+        self.timescale.close()
+
+
+class CassandraSink:
+    schema = SensorDataMessage
+    battery_query = "INSERT INTO sensor.battery (id, battery_level) VALUES (%s, %s) USING TIMESTAMP %s;"
+    battery_delete_query = "DELETE FROM sensor.battery USING TIMESTAMP %s WHERE id = %s;"
+    temperature_query = "INSERT INTO sensor.temperature_readings (id, month, value_id, temperature) VALUES (%s, %s, %s, %s);"
+    seed_query = "SELECT id, WRITETIME(battery_level) AS written FROM sensor.battery;"
+
+    def __init__(self):
+        self.cassandra = CassandraClient(hosts=[os.environ.get("CASSANDRA_HOST", "cassandra")])
+        create_schema(self.cassandra)
+        self.redis = RedisClient(host=os.environ.get("REDIS_HOST", "redis"))
+        self.untrack = self.redis.register_script(UNTRACK_SCRIPT)
+        if not self.redis.exists(LOW_BATTERY_KEY):
+            self.seed_low_sensors()
+
+    def seed_low_sensors(self):
+        # The sensors already in the table when the set did not exist yet
+        written = {row.id: row.written for row in self.cassandra.execute(self.seed_query)}
+        if written:
+            self.redis.zadd(LOW_BATTERY_KEY, written, gt=True)
+
+    @staticmethod
+    def write_timestamp():
+        # Microseconds since the epoch, what the driver would use. Both
+        # battery writes of a batch take it explicitly so LOW_BATTERY_KEY
+        # can record it.
+        return time.time_ns() // 1000
+
+    @staticmethod
+    def battery_rows(messages, timestamp):
+        # Only the last reading of each sensor in the batch counts, in
+        # arrival order. Low sensors are upserted and healthy ones are
+        # candidates for delete, both blind writes.
+        latest = {}
+        for m in messages:
+            latest[m.sensor_id] = m.battery_level
+        low = [(sensor_id, to_decimal(level), timestamp)
+               for sensor_id, level in latest.items() if level < LOW_BATTERY_THRESHOLD]
+        healthy = [sensor_id for sensor_id, level in latest.items() if level >= LOW_BATTERY_THRESHOLD]
+        return low, healthy
+
+    @staticmethod
+    def recovered(healthy, scores, timestamp):
+        # The healthy sensors to delete, scores being ZMSCORE's answer for
+        # them. A sensor upserted after `timestamp` by another batch would
+        # not be deleted by it anyway.
+        return [sensor_id for sensor_id, written in zip(healthy, scores) if written is not None and written <= timestamp]
+
+    @staticmethod
+    def temperature_rows(messages):
+        rows = []
+        for m in messages:
+            if m.temperature is None:
+                continue
+            time = reading_time(m)
+            if time is None:
+                INVALID.labels('cassandra').inc()
+                continue
+            rows.append((m.sensor_id, month_of(time), value_id(time, m.to_json()), to_decimal(m.temperature)))
+        return rows
+
+    @staticmethod
+    def temperature_partition(row):
+        return row[0], row[1]
+
+    def write(self, messages):
+        timestamp = self.write_timestamp()
+        low, healthy = self.battery_rows(messages, timestamp)
+        if low:
+            # Tracked before the upsert, so every sensor in the table is in
+            # the set even if the write below fails half way. GT keeps the
+            # newest timestamp when batches race.
+            self.redis.zadd(LOW_BATTERY_KEY, {row[0]: timestamp for row in low}, gt=True)
+            self.cassandra.execute_concurrent(self.battery_query, low)
+        if healthy:
+            recovered = self.recovered(healthy, self.redis.zmscore(LOW_BATTERY_KEY, healthy), timestamp)
+            if recovered:
+                self.cassandra.execute_concurrent(self.battery_delete_query, [(timestamp, sensor_id) for sensor_id in recovered])
+                self.untrack(keys=[LOW_BATTERY_KEY], args=[timestamp, *recovered])
+        temperatures = self.temperature_rows(messages)
+        if temperatures:
+            self.cassandra.execute_batches(self.temperature_query, temperatures, self.temperature_partition)
+
+    def close(self):
+        self.cassandra.close()
+        self.redis.close()
+
+
+class ElasticsearchSink:
+    # Follows the sensor_events exchange and applies the creates and deletes
+    # of a whole batch in one _bulk request. The documents become searchable
+    # on the next index refresh (ES_REFRESH_INTERVAL), not one by one.
+    schema = SensorEvent
+
+    def __init__(self):
+        self.es = ElasticsearchClient(host=os.environ.get("ES_HOST", "elasticsearch"))
+        search_index.ensure_index(self.es)
+
+    @staticmethod
+    def operations(events):
+        # Only the last event of each sensor in the batch matters
+        latest = {}
+        for event in events:
+            latest[event.sensor_id] = event
+        operations = []
+        for event in latest.values():
+            if event.event == "created" and event.sensor:
+                operations += search_index.index_action(event.sensor)
+            elif event.event == "deleted":
+                operations += search_index.delete_action(event.sensor_id)
+        return operations
+
+    @staticmethod
+    def deleted_names(events):
+        return sorted({event.sensor['name'] for event in events
+                       if event.event == "deleted" and event.sensor and event.sensor.get('name')})
+
+    def write(self, events):
+        operations = self.operations(events)
+        if operations:
+            search_index.check_bulk(self.es.bulk(operations))
+        names = self.deleted_names(events)
+        if names:
+            self.es.delete_by_query(search_index.INDEX_NAME, search_index.legacy_delete_query(names))
+
+    def close(self):
+        self.es.close()
+
+
+def reading_time(message):
+    try:
+        return datetime.fromisoformat(message.last_seen)
+    except ValueError:
+        return None
+
+
+def to_decimal(value):
+    # Bound decimals are encoded exactly, Decimal(0.1) would store every
+    # digit of the binary float, so go through its shortest repr like a CQL
+    # literal does
+    return Decimal(repr(value))
+
+
+SINKS = {
+    'redis': RedisSink,
+    'timescale': TimescaleSink,
+    'cassandra': CassandraSink,
+    'elasticsearch': ElasticsearchSink,
+}
@@ -0,0 +1,131 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+
+from consumer import async_main, main, metrics
+from consumer.async_sinks import ASYNC_SINKS
+from shared import metrics as prometheus
+
+# Worker processes per sink, one per core unless told otherwise
+WORKERS = int(os.environ.get("CONSUMER_WORKERS", os.cpu_count() or 1))
+# Seconds a worker gets to flush and ack its last batch after SIGTERM
+SHUTDOWN_TIMEOUT = int(os.environ.get("CONSUMER_SHUTDOWN_TIMEOUT", 30))
+CHECK_INTERVAL = 1
+# A worker that dies is restarted after RESTART_DELAY seconds, doubled for
+# each death in a row up to RESTART_MAX_DELAY, so one that fails on startup
+# (a broker or database that is down) does not respawn every second. A
+# worker that ran for RESTART_MAX_DELAY seconds resets the delay of its slot.
+RESTART_DELAY = 1
+RESTART_MAX_DELAY = int(os.environ.get("CONSUMER_RESTART_MAX_DELAY", 60))
+
+REGISTRY = prometheus.Registry()
+WORKERS_ALIVE = REGISTRY.gauge('consumer_workers', 'Worker processes running', ['sink'])
+RESTARTS = REGISTRY.counter('consumer_worker_restarts_total', 'Worker processes that died and were restarted', ['sink'])
+
+
+def work(sink_name, metrics_channel, index):
+    # Ctrl-C reaches the whole process group, but only the supervisor
+    # decides when workers stop. They drain on the SIGTERM it sends.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Sinks without an asyncio version run the blocking worker either way
+    if os.environ.get("CONSUMER_MODE") == "async" and sink_name in ASYNC_SINKS:
+        asyncio.run(async_main.run([sink_name], metrics_channel, index))
+    else:
+        main.run(sink_name, metrics_channel, index)
+
+
+class Supervisor:
+    # Runs a fixed number of consumer processes for one sink, each with its
+    # own broker connection and prefetch, and restarts the ones that die.
+    # It also serves /metrics for all of them (consumer/metrics.py).
+
+    def __init__(self, sink_name, workers=WORKERS):
+        self.sink_name = sink_name
+        self.workers = [None] * workers
+        # Per slot: when its worker started, the delay of its next restart
+        # and when that restart is due (None while the worker runs)
+        self.started = [0.0] * workers
+        self.delays = [RESTART_DELAY] * workers
+        self.restart_at = [None] * workers
+        self.stopping = False
+        self.metrics_channel = multiprocessing.Queue()
+        # Latest registry snapshot of each worker
+        self.snapshots = {}
+        self.alive = WORKERS_ALIVE.labels(sink_name)
+        self.restarts = RESTARTS.labels(sink_name)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        threading.Thread(target=self.collect, name="metrics-collect", daemon=True).start()
+        prometheus.serve(metrics.port(self.sink_name), self.render)
+
+        for i in range(len(self.workers)):
+            self.start_worker(i)
+
+        while not self.stopping:
+            for i, worker in enumerate(self.workers):
+                if not worker.is_alive() and not self.stopping:
+                    self.restart(i)
+            self.alive.set(sum(worker.is_alive() for worker in self.workers))
+            time.sleep(CHECK_INTERVAL)
+
+        self.shutdown()
+
+    def start_worker(self, i):
+        worker = multiprocessing.Process(target=work, args=(self.sink_name, self.metrics_channel, i),
+                                         name=f"consumer-{self.sink_name}-{i}")
+        worker.start()
+        self.workers[i] = worker
+        self.started[i] = time.monotonic()
+        self.restart_at[i] = None
+
+    def restart(self, i):
+        # Called every CHECK_INTERVAL while the worker of slot i is dead
+        now = time.monotonic()
+        if self.restart_at[i] is None:
+            if now - self.started[i] >= RESTART_MAX_DELAY:
+                self.delays[i] = RESTART_DELAY
+            delay = self.delays[i]
+            self.delays[i] = min(delay * 2, RESTART_MAX_DELAY)
+            self.restart_at[i] = now + delay
+            worker = self.workers[i]
+            print(f"{worker.name} exited with code {worker.exitcode}, restarting it in {delay}s")
+        if now >= self.restart_at[i]:
+            self.restarts.inc()
+            self.start_worker(i)
+
+    def collect(self):
+        while True:
+            worker, snapshot = self.metrics_channel.get()
+            self.snapshots[worker] = snapshot
+
+    def render(self):
+        snapshots = [({'worker': str(worker)}, snapshot) for worker, snapshot in sorted(dict(self.snapshots).items())]
+        return prometheus.render([({}, REGISTRY.snapshot())] + snapshots)
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+    def shutdown(self):
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for worker in self.workers:
+            worker.join(max(0, deadline - time.monotonic()))
+            if worker.is_alive():
+                print(f"{worker.name} did not drain in {SHUTDOWN_TIMEOUT}s, killing it")
+                worker.kill()
+
+
+if __name__ == "__main__":
+    # python consumer/supervisor.py <redis|timescale|cassandra>
+    Supervisor(sys.argv[1] if len(sys.argv) > 1 else os.environ["CONSUMER_SINK"]).run()
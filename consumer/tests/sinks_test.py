@@ -0,0 +1,115 @@
+from consumer.sinks import LOW_BATTERY_KEY, UNTRACK_SCRIPT, CassandraSink
+from shared.sensors.schemas import SensorDataMessage
+
+
+class FakeRedis:
+    def __init__(self):
+        self.sorted_sets = {}
+
+    def zadd(self, key, mapping, gt=False):
+        scores = self.sorted_sets.setdefault(key, {})
+        for member, score in mapping.items():
+            if not gt or member not in scores or score > scores[member]:
+                scores[member] = score
+
+    def zmscore(self, key, members):
+        return [self.sorted_sets.get(key, {}).get(member) for member in members]
+
+    def register_script(self, script):
+        assert script == UNTRACK_SCRIPT
+
+        def untrack(keys, args):
+            scores = self.sorted_sets.get(keys[0], {})
+            timestamp, ids = args[0], args[1:]
+            for sensor_id in ids:
+                if sensor_id in scores and scores[sensor_id] <= timestamp:
+                    del scores[sensor_id]
+        return untrack
+
+
+class FakeCassandra:
+    # sensor.battery with last write wins by timestamp, a delete winning a tie
+    def __init__(self):
+        self.cells = {}
+        self.deletes = 0
+        self.before_delete = None
+
+    def execute_concurrent(self, query, params_list):
+        if query == CassandraSink.battery_query:
+            for sensor_id, level, timestamp in params_list:
+                if sensor_id not in self.cells or timestamp > self.cells[sensor_id][0]:
+                    self.cells[sensor_id] = (timestamp, level)
+        else:
+            hook, self.before_delete = self.before_delete, None
+            if hook is not None:
+                hook()
+            for timestamp, sensor_id in params_list:
+                self.deletes += 1
+                if sensor_id not in self.cells or timestamp >= self.cells[sensor_id][0]:
+                    self.cells[sensor_id] = (timestamp, None)
+
+    def execute_batches(self, query, params_list, partition_key):
+        pass
+
+    def battery(self):
+        return {sensor_id: float(level) for sensor_id, (_, level) in self.cells.items() if level is not None}
+
+
+def sink(redis, cassandra, clock):
+    sink = CassandraSink.__new__(CassandraSink)
+    sink.redis, sink.cassandra = redis, cassandra
+    sink.untrack = redis.register_script(UNTRACK_SCRIPT)
+    sink.write_timestamp = lambda: clock[0]
+    return sink
+
+
+def reading(battery_level, last_seen):
+    return SensorDataMessage(sensor_id=3, velocity=1.0, battery_level=battery_level, last_seen=last_seen)
+
+
+def tracked(redis):
+    return redis.sorted_sets.get(LOW_BATTERY_KEY, {})
+
+
+def test_readings_out_of_order_leave_nothing_behind():
+    redis, cassandra, clock = FakeRedis(), FakeCassandra(), [100]
+    consumer = sink(redis, cassandra, clock)
+    for battery_level, last_seen in [(0.1, "2020-01-05T00:00:00"), (0.9, "2020-01-04T00:00:00"),
+                                     (0.9, "2020-01-06T00:00:00")]:
+        consumer.write([reading(battery_level, last_seen)])
+        clock[0] += 1
+    # The last reading applied decides, the healthy one at T4 removed the row
+    assert cassandra.battery() == {}
+    assert tracked(redis) == {}
+    assert cassandra.deletes == 1
+
+
+def test_healthy_sensors_are_not_deleted():
+    redis, cassandra = FakeRedis(), FakeCassandra()
+    sink(redis, cassandra, [100]).write([reading(0.9, "2020-01-01T00:00:00"), reading(0.5, "2020-01-02T00:00:00")])
+    assert cassandra.deletes == 0
+
+
+def test_upsert_racing_a_delete_stays_tracked():
+    redis, cassandra = FakeRedis(), FakeCassandra()
+    sink(redis, cassandra, [100]).write([reading(0.1, "2020-01-01T00:00:00")])
+    # Another worker writes a newer low reading while this delete is in flight
+    other = sink(redis, cassandra, [104])
+    cassandra.before_delete = lambda: other.write([reading(0.15, "2020-01-03T00:00:00")])
+    sink(redis, cassandra, [103]).write([reading(0.9, "2020-01-02T00:00:00")])
+    assert cassandra.battery() == {3: 0.15}
+    assert tracked(redis) == {3: 104}
+
+    sink(redis, cassandra, [105]).write([reading(0.9, "2020-01-04T00:00:00")])
+    assert cassandra.battery() == {}
+    assert tracked(redis) == {}
+
+
+def test_older_upsert_racing_a_delete_is_deleted_and_untracked():
+    redis, cassandra = FakeRedis(), FakeCassandra()
+    sink(redis, cassandra, [100]).write([reading(0.1, "2020-01-01T00:00:00")])
+    other = sink(redis, cassandra, [102])
+    cassandra.before_delete = lambda: other.write([reading(0.15, "2020-01-03T00:00:00")])
+    sink(redis, cassandra, [103]).write([reading(0.9, "2020-01-02T00:00:00")])
+    assert cassandra.battery() == {}
+    assert tracked(redis) == {}
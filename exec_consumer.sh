@@ -1,4 +1,8 @@
 path= pwd
 export PYTHONPATH=$PYTHONPATH:$path
 echo $PYTHONPATH
-python ./consumer/main.py
\ No newline at end of file
+for sink in redis timescale cassandra elasticsearch
+do
+    python ./consumer/supervisor.py $sink &
+done
+wait
@@ -0,0 +1,80 @@
+-- Persistent continuous aggregates of sensor_data, one per bucket size the
+-- API can query. Real time aggregation is on, so the rows not materialized
+-- yet are still read from sensor_data.
+-- depends: migrations_ts
+-- transactional: false
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS sensor_data_hourly
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT
+    id,
+    AVG(velocity) AS vel,
+    AVG(temperature) AS temp,
+    AVG(humidity) AS hum,
+    MIN(battery_level) AS bat,
+    time_bucket('1 hour', last_seen) AS time
+FROM sensor_data
+GROUP BY id, time_bucket('1 hour', last_seen)
+WITH NO DATA;
+
+SELECT add_continuous_aggregate_policy('sensor_data_hourly', start_offset => NULL, end_offset => INTERVAL '1 hour', schedule_interval => INTERVAL '5 minutes', if_not_exists => TRUE);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS sensor_data_daily
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT
+    id,
+    AVG(velocity) AS vel,
+    AVG(temperature) AS temp,
+    AVG(humidity) AS hum,
+    MIN(battery_level) AS bat,
+    time_bucket('1 day', last_seen) AS time
+FROM sensor_data
+GROUP BY id, time_bucket('1 day', last_seen)
+WITH NO DATA;
+
+SELECT add_continuous_aggregate_policy('sensor_data_daily', start_offset => NULL, end_offset => INTERVAL '1 day', schedule_interval => INTERVAL '30 minutes', if_not_exists => TRUE);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS sensor_data_weekly
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT
+    id,
+    AVG(velocity) AS vel,
+    AVG(temperature) AS temp,
+    AVG(humidity) AS hum,
+    MIN(battery_level) AS bat,
+    time_bucket('1 week', last_seen) AS time
+FROM sensor_data
+GROUP BY id, time_bucket('1 week', last_seen)
+WITH NO DATA;
+
+SELECT add_continuous_aggregate_policy('sensor_data_weekly', start_offset => NULL, end_offset => INTERVAL '1 week', schedule_interval => INTERVAL '1 hour', if_not_exists => TRUE);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS sensor_data_monthly
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT
+    id,
+    AVG(velocity) AS vel,
+    AVG(temperature) AS temp,
+    AVG(humidity) AS hum,
+    MIN(battery_level) AS bat,
+    time_bucket('1 month', last_seen) AS time
+FROM sensor_data
+GROUP BY id, time_bucket('1 month', last_seen)
+WITH NO DATA;
+
+SELECT add_continuous_aggregate_policy('sensor_data_monthly', start_offset => NULL, end_offset => INTERVAL '1 month', schedule_interval => INTERVAL '1 hour', if_not_exists => TRUE);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS sensor_data_yearly
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT
+    id,
+    AVG(velocity) AS vel,
+    AVG(temperature) AS temp,
+    AVG(humidity) AS hum,
+    MIN(battery_level) AS bat,
+    time_bucket('1 year', last_seen) AS time
+FROM sensor_data
+GROUP BY id, time_bucket('1 year', last_seen)
+WITH NO DATA;
+
+SELECT add_continuous_aggregate_policy('sensor_data_yearly', start_offset => NULL, end_offset => INTERVAL '1 year', schedule_interval => INTERVAL '1 day', if_not_exists => TRUE);
@@ -0,0 +1,14 @@
+-- One row per sensor and timestamp, so a reading delivered twice is only
+-- stored once (the sinks insert with ON CONFLICT DO NOTHING). Two different
+-- readings of a sensor with the same last_seen are one row too: the first
+-- one stored is kept and the other dropped, while the redis stats and
+-- cassandra keep both.
+-- The existing duplicates have to go or the index cannot be built. This is
+-- intended and keeps one arbitrary row of each (id, last_seen).
+-- depends: 20240501_01_aggregates
+
+DELETE FROM sensor_data a
+USING sensor_data b
+WHERE a.id = b.id AND a.last_seen = b.last_seen AND a.ctid > b.ctid;
+
+CREATE UNIQUE INDEX IF NOT EXISTS sensor_data_id_last_seen ON sensor_data (id, last_seen);
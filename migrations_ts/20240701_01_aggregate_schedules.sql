@@ -0,0 +1,22 @@
+-- Real time aggregation only reads sensor_data above the watermark of each
+-- view, the end of its last materialized bucket. A reading backfilled below
+-- it stays invisible until the next refresh, which was up to a day for the
+-- yearly view. The refreshes only recompute the buckets that changed since
+-- the last run, so running them every few minutes is cheap when nothing was
+-- backfilled and bounds that staleness to the schedule interval.
+-- depends: 20240601_01_unique_readings
+
+SELECT remove_continuous_aggregate_policy('sensor_data_hourly', if_exists => TRUE);
+SELECT add_continuous_aggregate_policy('sensor_data_hourly', start_offset => NULL, end_offset => INTERVAL '1 hour', schedule_interval => INTERVAL '1 minute');
+
+SELECT remove_continuous_aggregate_policy('sensor_data_daily', if_exists => TRUE);
+SELECT add_continuous_aggregate_policy('sensor_data_daily', start_offset => NULL, end_offset => INTERVAL '1 day', schedule_interval => INTERVAL '1 minute');
+
+SELECT remove_continuous_aggregate_policy('sensor_data_weekly', if_exists => TRUE);
+SELECT add_continuous_aggregate_policy('sensor_data_weekly', start_offset => NULL, end_offset => INTERVAL '1 week', schedule_interval => INTERVAL '5 minutes');
+
+SELECT remove_continuous_aggregate_policy('sensor_data_monthly', if_exists => TRUE);
+SELECT add_continuous_aggregate_policy('sensor_data_monthly', start_offset => NULL, end_offset => INTERVAL '1 month', schedule_interval => INTERVAL '5 minutes');
+
+SELECT remove_continuous_aggregate_policy('sensor_data_yearly', if_exists => TRUE);
+SELECT add_continuous_aggregate_policy('sensor_data_yearly', start_offset => NULL, end_offset => INTERVAL '1 year', schedule_interval => INTERVAL '5 minutes');
@@ -0,0 +1,172 @@
+import asyncio
+import collections
+import os
+import traceback
+
+import aio_pika
+
+from shared import retry
+from shared.publisher import EXCHANGE_NAME, SENSOR_EVENTS_EXCHANGE, queue_arguments, queue_bindings
+from shared.subscriber import Delivery, BATCH_SIZE, FLUSH_INTERVAL, PREFETCH
+
+# Batches being written at the same time by one consumer
+MAX_IN_FLIGHT = int(os.environ.get("CONSUMER_MAX_IN_FLIGHT", 4))
+
+
+class _Batch:
+    def __init__(self, messages):
+        self.messages = messages
+        self.done = False
+        self.ok = False
+
+
+class AsyncSubscriber:
+    # asyncio counterpart of Subscriber.subscribe_batch. Batches are built the
+    # same way, but up to MAX_IN_FLIGHT of them are written concurrently while
+    # the event loop keeps receiving messages and answering heartbeats.
+    # Batches can finish out of order, yet each one is acked with
+    # multiple=True, so acks are only sent once every older batch is settled.
+    # Delivery tags belong to a channel, so every queue is consumed on a
+    # channel of its own and a multiple ack never reaches another queue's
+    # messages.
+
+    def __init__(self):
+        self.conn = None
+        self.channel = None
+
+    async def connect(self):
+        # self.channel only declares the topology, see subscribe_batch
+        self.conn = await aio_pika.connect_robust(host=os.environ.get("RABBITMQ_HOST", "localhost"),
+                                                  login='guest', password='guest')
+        self.channel = await self.conn.channel()
+
+        exchanges = {}
+        for name in (EXCHANGE_NAME, SENSOR_EVENTS_EXCHANGE):
+            exchanges[name] = await self.channel.declare_exchange(name, aio_pika.ExchangeType.FANOUT, durable=True)
+        self.queues = {}
+        for name, exchange in queue_bindings():
+            queue = await self.channel.declare_queue(name, durable=True, arguments=queue_arguments(name))
+            await queue.bind(exchanges[exchange])
+            self.queues[name] = queue
+            for retry_queue, arguments in retry.retry_queues(name):
+                await self.channel.declare_queue(retry_queue, durable=True, arguments=arguments)
+
+    async def subscribe_batch(self, queue, on_batch, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                              max_in_flight=MAX_IN_FLIGHT, prefetch=PREFETCH):
+        # The prefetch has to cover every batch that can be in flight, or
+        # the broker stops delivering before the last ones fill up
+        channel = await self.conn.channel()
+        await channel.set_qos(prefetch_count=max(prefetch, batch_size * max_in_flight))
+        # Consumed (and later cancelled) through this channel's queue object
+        self.queues[queue] = await channel.declare_queue(queue, durable=True, arguments=queue_arguments(queue))
+        batcher = _Batcher(on_batch, batch_size, flush_interval, max_in_flight, channel, queue)
+        tag = await self.queues[queue].consume(batcher.on_message)
+        return batcher, tag
+
+    async def close(self):
+        await self.conn.close()
+
+
+class _Batcher:
+    def __init__(self, on_batch, batch_size, flush_interval, max_in_flight, channel, queue):
+        self._on_batch = on_batch
+        self._channel = channel
+        self._queue = queue
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._buffer = []
+        self._timer = None
+        self._pending = collections.deque()
+        self._settling = asyncio.Lock()
+        self._tasks = set()
+
+    async def on_message(self, message):
+        self._buffer.append(message)
+        if len(self._buffer) >= self._batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self._flush_interval, self.flush)
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buffer:
+            return
+
+        batch = _Batch(self._buffer)
+        self._buffer = []
+        self._pending.append(batch)
+        task = asyncio.create_task(self._write(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def drain(self):
+        # Flush what is buffered and wait for every batch to be settled
+        self.flush()
+        while self._tasks:
+            await asyncio.gather(*self._tasks)
+
+    async def _write(self, batch):
+        async with self._slots:
+            failed = await self._write_parts(batch.messages)
+            if failed:
+                print(f"{len(failed)} of {len(batch.messages)} messages could not be written, "
+                      "sending them to their delay queue")
+            batch.ok = not failed or await self._retry(failed)
+            batch.done = True
+            await self._settle()
+
+    async def _write_parts(self, messages):
+        # Subscriber._write: the messages that could not be written, after
+        # writing the failed parts again in halves
+        parts = collections.deque([(messages, False)])
+        failed = []
+        attempts = 0
+        while parts:
+            part, split = parts.popleft()
+            if split:
+                if attempts == retry.SPLIT_ATTEMPTS:
+                    failed += part
+                    continue
+                attempts += 1
+            try:
+                await self._on_batch([Delivery(message.message_id, message.content_type, message.body) for message in part],
+                                     split=split)
+            except Exception:
+                if not split:
+                    traceback.print_exc()
+                if len(part) == 1:
+                    failed += part
+                else:
+                    middle = len(part) // 2
+                    parts.extendleft([(part[middle:], True), (part[:middle], True)])
+        return failed
+
+    async def _retry(self, messages):
+        # Sends the messages to their delay queue (shared/retry.py). False if
+        # that failed too and the batch has to be requeued.
+        try:
+            for message in messages:
+                headers = retry.retry_headers(message.headers)
+                await self._channel.default_exchange.publish(
+                    aio_pika.Message(message.body, content_type=message.content_type, message_id=message.message_id,
+                                     headers=headers,
+                                     delivery_mode=aio_pika.DeliveryMode.PERSISTENT),
+                    routing_key=retry.next_queue(self._queue, headers[retry.ATTEMPT_HEADER]))
+            return True
+        except Exception:
+            traceback.print_exc()
+            return False
+
+    async def _settle(self):
+        # The lock keeps the acks on the wire in delivery tag order
+        async with self._settling:
+            while self._pending and self._pending[0].done:
+                batch = self._pending.popleft()
+                last = batch.messages[-1]
+                if batch.ok:
+                    await last.ack(multiple=True)
+                else:
+                    await last.nack(multiple=True, requeue=True)
@@ -1,12 +1,70 @@
+import threading
+
 from cassandra.cluster import Cluster
+from cassandra.concurrent import execute_concurrent, execute_concurrent_with_args
+from cassandra.policies import DCAwareRoundRobinPolicy, TokenAwarePolicy
+from cassandra.query import BatchStatement, BatchType
 
 class CassandraClient:
     def __init__(self, hosts):
-        self.cluster = Cluster(hosts,protocol_version=4)
+        # Token aware routing sends each bound statement (and each single
+        # partition batch) straight to a replica that owns its partition
+        self.cluster = Cluster(hosts, protocol_version=4,
+                               load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy()))
         self.session = self.cluster.connect()
+        self._prepared = {}
+        self._prepare_lock = threading.Lock()
 
     def get_session(self):
         return self.session
 
     def close(self):
         self.cluster.shutdown()
+
+    def prepare(self, query):
+        # Statements are prepared once per query text and reused, the cluster
+        # no longer parses the CQL on every call. Queries keep the %s
+        # placeholders used everywhere else.
+        statement = self._prepared.get(query)
+        if statement is None:
+            with self._prepare_lock:
+                statement = self._prepared.get(query)
+                if statement is None:
+                    statement = self._prepared[query] = self.session.prepare(query.replace('%s', '?'))
+        return statement
+
+    def execute(self, query, params=None):
+        if params and isinstance(query, str):
+            return self.get_session().execute(self.prepare(query), params)
+        elif params:
+            return self.get_session().execute(query, params)
+        else:
+            return self.get_session().execute(query)
+
+    def execute_concurrent(self, query, params_list, concurrency=100):
+        # Runs the same statement for every set of params with up to
+        # `concurrency` requests in flight
+        return execute_concurrent_with_args(self.get_session(), self.prepare(query), params_list,
+                                            concurrency=concurrency, raise_on_first_error=True)
+
+    def partition_batches(self, query, params_list, partition_key, max_size=100):
+        # Unlogged batches are only cheap when every row in them goes to the
+        # same partition, so rows are grouped by partition_key(params) first
+        statement = self.prepare(query)
+        partitions = {}
+        for params in params_list:
+            partitions.setdefault(partition_key(params), []).append(params)
+
+        batches = []
+        for rows in partitions.values():
+            for i in range(0, len(rows), max_size):
+                batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+                for params in rows[i:i + max_size]:
+                    batch.add(statement, params)
+                batches.append(batch)
+        return batches
+
+    def execute_batches(self, query, params_list, partition_key, concurrency=100):
+        batches = self.partition_batches(query, params_list, partition_key)
+        return execute_concurrent(self.get_session(), [(batch, None) for batch in batches],
+                                  concurrency=concurrency, raise_on_first_error=True)
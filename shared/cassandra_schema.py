@@ -0,0 +1,66 @@
+import hashlib
+import sys
+from datetime import datetime, timezone
+
+from cassandra.query import SimpleStatement
+from cassandra.util import uuid_from_time
+
+# Temperature readings are partitioned per sensor and month, and clustered by
+# a timeuuid built from the reading time. Writes never read, and partitions
+# stay bounded however long a sensor keeps sending.
+SCHEMA = [
+    "CREATE KEYSPACE IF NOT EXISTS sensor WITH replication =  {'class': 'SimpleStrategy', 'replication_factor' : 3};",
+    "CREATE TABLE IF NOT EXISTS sensor.temperature_readings (id int, month int, value_id timeuuid, temperature decimal, PRIMARY KEY ((id, month), value_id)) WITH comment = 'Find values temperature'",
+    "CREATE TABLE IF NOT EXISTS sensor.types (type text PRIMARY KEY, count counter) WITH comment = 'Find number of types of sensor';",
+    "CREATE TABLE IF NOT EXISTS sensor.battery (id int PRIMARY KEY, battery_level decimal) WITH comment = 'Find sensor with battery level <20%';",
+]
+
+# Rows copied from the old sensor.temperature_values table have no reading
+# time, they all go to this month
+LEGACY_MONTH = 0
+
+
+def create_schema(cassandra):
+    for statement in SCHEMA:
+        cassandra.execute(statement)
+
+
+def month_of(time):
+    return time.year * 100 + time.month
+
+
+def value_id(time, key):
+    # A timeuuid for the reading time whose node and clock sequence come from
+    # a hash of the reading, so a redelivered reading overwrites its own row
+    # instead of adding a new one
+    digest = hashlib.sha1(key.encode()).digest()
+    return uuid_from_time(time, node=int.from_bytes(digest[:6], 'big'), clock_seq=int.from_bytes(digest[6:8], 'big') & 0x3fff)
+
+
+def migrate_temperature_values(cassandra, fetch_size=1000):
+    # Copies sensor.temperature_values (id, value_id int) into
+    # sensor.temperature_readings. The ids are derived from the old rows, so
+    # the migration can be run again after an interruption. The old table is
+    # left in place, drop it once the copy has been checked.
+    insert = cassandra.get_session().prepare(
+        "INSERT INTO sensor.temperature_readings (id, month, value_id, temperature) VALUES (?, ?, ?, ?)")
+    old_rows = cassandra.execute(SimpleStatement("SELECT id, value_id, temperature FROM sensor.temperature_values", fetch_size=fetch_size))
+
+    copied = 0
+    for row in old_rows:
+        time = datetime.fromtimestamp(row.value_id, tz=timezone.utc)
+        cassandra.execute(insert, (row.id, LEGACY_MONTH, value_id(time, f"{row.id}:{row.value_id}"), row.temperature))
+        copied += 1
+    return copied
+
+
+if __name__ == "__main__":
+    # python -m shared.cassandra_schema [migrate] [host]
+    from shared.cassandra_client import CassandraClient
+
+    host = sys.argv[2] if len(sys.argv) > 2 else "cassandra"
+    cassandra = CassandraClient(hosts=[host])
+    create_schema(cassandra)
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        print("Copied", migrate_temperature_values(cassandra), "rows to sensor.temperature_readings")
+    cassandra.close()
@@ -0,0 +1,76 @@
+import json
+import os
+
+import msgpack
+from pydantic import ValidationError
+
+from shared.sensors.schemas import SensorDataMessage
+
+# How readings travel on the queue. JSON is one object per reading (or an
+# array of them). msgpack is an array of fixed-order rows, so the field names
+# are not repeated and decoding skips the JSON parser. The content type of
+# each message says which one it is, so publishers can be switched over
+# while consumers keep reading the old messages.
+JSON = 'application/json'
+MSGPACK = 'application/x-msgpack'
+CONTENT_TYPES = {'json': JSON, 'msgpack': MSGPACK}
+
+WIRE_FORMAT = CONTENT_TYPES[os.environ.get("QUEUE_WIRE_FORMAT", "json")]
+# Readings packed into one AMQP message when many are published together
+READINGS_PER_MESSAGE = int(os.environ.get("QUEUE_READINGS_PER_MESSAGE", 1))
+
+FIELDS = ('sensor_id', 'velocity', 'temperature', 'humidity', 'battery_level', 'last_seen')
+
+
+def encode(messages, content_type=WIRE_FORMAT):
+    # One body for a list of readings
+    if content_type == MSGPACK:
+        return msgpack.packb([[getattr(m, field) for field in FIELDS] for m in messages])
+    if len(messages) == 1:
+        return messages[0].to_json()
+    return '[' + ','.join(m.to_json() for m in messages) + ']'
+
+
+def decode(body, content_type=JSON):
+    # The readings in a body. Raises ValueError (or ValidationError, a
+    # subclass) if the body is not a list of valid readings.
+    if content_type == MSGPACK:
+        try:
+            rows = msgpack.unpackb(body)
+        except Exception as e:
+            raise ValueError(f"Invalid msgpack body: {e}")
+        if not isinstance(rows, list):
+            raise ValueError(f"Invalid msgpack body: expected a list of rows, got {rows!r}")
+        return [from_row(row) for row in rows]
+
+    data = json.loads(body)
+    if isinstance(data, list):
+        return [SensorDataMessage.parse_obj(item) for item in data]
+    return [SensorDataMessage.parse_obj(data)]
+
+
+def from_row(row):
+    # The rows come from our own publisher with a fixed layout, a type check
+    # is all the validation they need
+    if not isinstance(row, list) or len(row) != len(FIELDS):
+        raise ValueError(f"Invalid reading row: {row!r}")
+    sensor_id, velocity, temperature, humidity, battery_level, last_seen = row
+    if (type(sensor_id) is not int or not isinstance(last_seen, str) or not _is_number(battery_level)
+            or not all(value is None or _is_number(value) for value in (velocity, temperature, humidity))):
+        raise ValueError(f"Invalid reading row: {row!r}")
+    return SensorDataMessage.construct(sensor_id=sensor_id, velocity=_float(velocity), temperature=_float(temperature),
+                                       humidity=_float(humidity), battery_level=float(battery_level), last_seen=last_seen)
+
+
+def _is_number(value):
+    return type(value) in (int, float)
+
+
+def _float(value):
+    return None if value is None else float(value)
+
+
+def chunks(messages, size=READINGS_PER_MESSAGE):
+    size = max(size, 1)
+    for i in range(0, len(messages), size):
+        yield messages[i:i + size]
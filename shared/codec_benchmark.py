@@ -0,0 +1,52 @@
+import random
+import sys
+import time
+
+from shared import codec
+from shared.sensors.schemas import SensorDataMessage
+
+# python -m shared.codec_benchmark [readings] [readings per message]
+# Bytes on the wire and encode/decode time per reading for each wire format.
+# Decoding includes building the SensorDataMessage objects the sinks use.
+
+
+def readings(count):
+    messages = []
+    for i in range(count):
+        messages.append(SensorDataMessage(
+            sensor_id=random.randint(1, 10000),
+            velocity=round(random.uniform(0, 120), 2) if i % 2 else None,
+            temperature=round(random.uniform(-10, 40), 2) if not i % 2 else None,
+            humidity=round(random.uniform(0, 100), 2) if not i % 2 else None,
+            battery_level=round(random.random(), 3),
+            last_seen=f"2024-01-01T00:{i // 60 % 60:02d}:{i % 60:02d}.000Z"))
+    return messages
+
+
+def measure(messages, content_type, per_message):
+    start = time.perf_counter()
+    bodies = [codec.encode(chunk, content_type) for chunk in codec.chunks(messages, per_message)]
+    encoded = time.perf_counter() - start
+
+    start = time.perf_counter()
+    decoded = [reading for body in bodies for reading in codec.decode(body, content_type)]
+    elapsed = time.perf_counter() - start
+    assert [m.dict() for m in decoded] == [m.dict() for m in messages]
+
+    size = sum(len(body) for body in bodies)
+    return size / len(messages), encoded / len(messages) * 1e6, elapsed / len(messages) * 1e6
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    batch = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    messages = readings(count)
+
+    print(f"{count} readings")
+    print(f"{'format':<22}{'bytes/reading':>15}{'encode us':>12}{'decode us':>12}")
+    for name, content_type, per_message in [("json", codec.JSON, 1),
+                                            (f"json x{batch}", codec.JSON, batch),
+                                            ("msgpack", codec.MSGPACK, 1),
+                                            (f"msgpack x{batch}", codec.MSGPACK, batch)]:
+        size, encode_us, decode_us = measure(messages, content_type, per_message)
+        print(f"{name:<22}{size:>15.1f}{encode_us:>12.2f}{decode_us:>12.2f}")
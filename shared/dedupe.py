@@ -0,0 +1,138 @@
+import os
+import time
+
+import redis
+import redis.asyncio
+
+# Every reading message carries a message_id derived from its body (see
+# shared/publisher.py). A consumer that crashes after writing a batch but
+# before acking it gets the batch again, and a publisher that retries after
+# a lost confirm sends the same message twice. The ids each sink queue has
+# written go into one redis set per DEDUPE_WINDOW seconds, and a message
+# found in the current or the previous set is skipped, so a copy is caught
+# for at least one window. 0 turns it off.
+DEDUPE_WINDOW = int(os.environ.get("CONSUMER_DEDUPE_WINDOW", 300))
+# Hex digits of the message id kept in the sets. 64 bits make a collision
+# within a window negligible at a fraction of the memory of the full id.
+ID_LENGTH = 16
+
+
+def seen_key(queue, bucket):
+    return f"seen:{queue}:{bucket}"
+
+
+class Deduplicator:
+    # One per sink queue. unseen() runs before the batch is written and
+    # mark() after, one round trip each. If redis is unreachable nothing is
+    # filtered: writing a reading twice is better than losing it.
+
+    def __init__(self, queue, host=None, window=DEDUPE_WINDOW):
+        self.queue = queue
+        self.window = window
+        self.redis = self.client(host or os.environ.get("REDIS_HOST", "redis"))
+        self.skipped = 0
+
+    @staticmethod
+    def client(host):
+        return redis.Redis(host=host)
+
+    def _bucket(self):
+        return int(time.time() // self.window)
+
+    @staticmethod
+    def _ids(deliveries):
+        return [delivery.message_id[:ID_LENGTH] for delivery in deliveries if delivery.message_id is not None]
+
+    def _check(self, pipe, ids):
+        bucket = self._bucket()
+        pipe.smismember(seen_key(self.queue, bucket), ids)
+        pipe.smismember(seen_key(self.queue, bucket - 1), ids)
+
+    def _mark(self, pipe, ids):
+        key = seen_key(self.queue, self._bucket())
+        pipe.sadd(key, *ids)
+        # Read as the previous set during the next window, then dropped
+        pipe.expire(key, 2 * self.window)
+
+    def _filter(self, deliveries, found):
+        # found holds a flag per delivery with an id, in order. Copies that
+        # arrived in the same batch are dropped too.
+        flags = iter(found)
+        fresh = []
+        ids = set()
+        for delivery in deliveries:
+            if delivery.message_id is None:
+                # Published before messages had ids
+                fresh.append(delivery)
+                continue
+            message_id = delivery.message_id[:ID_LENGTH]
+            if not next(flags) and message_id not in ids:
+                ids.add(message_id)
+                fresh.append(delivery)
+        self.skipped += len(deliveries) - len(fresh)
+        return fresh
+
+    @staticmethod
+    def _found(current, previous):
+        return [bool(a) or bool(b) for a, b in zip(current, previous)]
+
+    def unseen(self, deliveries):
+        ids = self._ids(deliveries)
+        if not self.window or not ids:
+            return deliveries
+        pipe = self.redis.pipeline(transaction=False)
+        self._check(pipe, ids)
+        try:
+            return self._filter(deliveries, self._found(*pipe.execute()))
+        except redis.RedisError as e:
+            print("Could not check for duplicates:", e)
+            return deliveries
+
+    def mark(self, deliveries):
+        ids = self._ids(deliveries)
+        if not self.window or not ids:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        self._mark(pipe, ids)
+        try:
+            pipe.execute()
+        except redis.RedisError as e:
+            # The batch is written, at worst it is written again
+            print("Could not mark the batch as written:", e)
+
+    def close(self):
+        self.redis.close()
+
+
+class AsyncDeduplicator(Deduplicator):
+    # Same thing for consumer/async_main.py
+
+    @staticmethod
+    def client(host):
+        return redis.asyncio.Redis(host=host)
+
+    async def unseen(self, deliveries):
+        ids = self._ids(deliveries)
+        if not self.window or not ids:
+            return deliveries
+        pipe = self.redis.pipeline(transaction=False)
+        self._check(pipe, ids)
+        try:
+            return self._filter(deliveries, self._found(*await pipe.execute()))
+        except redis.RedisError as e:
+            print("Could not check for duplicates:", e)
+            return deliveries
+
+    async def mark(self, deliveries):
+        ids = self._ids(deliveries)
+        if not self.window or not ids:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        self._mark(pipe, ids)
+        try:
+            await pipe.execute()
+        except redis.RedisError as e:
+            print("Could not mark the batch as written:", e)
+
+    async def close(self):
+        await self.redis.close()
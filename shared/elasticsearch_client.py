@@ -20,8 +20,29 @@ class ElasticsearchClient:
     def close(self):
         self.client.close()
 
-    def create_index(self, index_name):
-        return self.client.indices.create(index=index_name)
+    def create_index(self, index_name, settings=None):
+        return self.client.indices.create(index=index_name, settings=settings)
+
+    def index_exists(self, index_name):
+        return self.client.indices.exists(index=index_name)
+
+    def delete_index(self, index_name):
+        return self.client.indices.delete(index=index_name)
+
+    def put_settings(self, index_name, settings):
+        return self.client.indices.put_settings(index=index_name, settings=settings)
+
+    def refresh(self, index_name):
+        return self.client.indices.refresh(index=index_name)
+
+    def alias_exists(self, alias):
+        return self.client.indices.exists_alias(name=alias)
+
+    def get_alias(self, alias):
+        return self.client.indices.get_alias(name=alias)
+
+    def update_aliases(self, actions):
+        return self.client.indices.update_aliases(actions=actions)
     
     def create_mapping(self, index_name, mapping):
         return self.client.indices.put_mapping(index=index_name, body=mapping)
@@ -31,6 +52,12 @@ class ElasticsearchClient:
     
     def index_document(self, index_name, document):
         return self.client.index(index=index_name, document=document)
+
+    def delete_by_query(self, index_name, query):
+        return self.client.delete_by_query(index=index_name, query=query)
+
+    def bulk(self, operations, refresh=None):
+        return self.client.bulk(operations=operations, refresh=refresh)
     
 
     
@@ -0,0 +1,199 @@
+import bisect
+import http.server
+import math
+import threading
+
+# A small Prometheus client: counters, gauges and histograms with labels,
+# rendered in the text exposition format. A registry can be snapshotted into
+# plain lists, so processes can send theirs to the one serving /metrics.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        # One lock for every value in the registry, held only to update or
+        # copy them
+        self.lock = threading.Lock()
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(Counter(self, name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._add(Gauge(self, name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(self, name, documentation, labelnames, buckets))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        # [(name, type, help, [(sample name, labels, value)])]
+        with self.lock:
+            return [(m.name, m.kind, m.documentation, m.samples()) for m in self.metrics]
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, documentation, labelnames):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+
+    def labels(self, *values, **kwargs):
+        # The child for these label values, callers keep it around so the
+        # lookup is not repeated on every update
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        values = tuple(str(value) for value in values)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}")
+        with self.registry.lock:
+            child = self.children.get(values)
+            if child is None:
+                child = self.children[values] = self._child()
+        return child
+
+    def samples(self):
+        samples = []
+        for values, child in self.children.items():
+            labels = tuple(zip(self.labelnames, values))
+            samples += [(self.name + suffix, labels + extra, value) for suffix, extra, value in child.samples()]
+        return samples
+
+
+class _Value:
+    def __init__(self, lock):
+        self._lock = lock
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [('', (), self.value)]
+
+
+class _GaugeValue(_Value):
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class _HistogramValue:
+    def __init__(self, lock, buckets):
+        self._lock = lock
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def samples(self):
+        samples = []
+        total = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            total += count
+            samples.append(('_bucket', (('le', _format(bound)),), total))
+        samples.append(('_sum', (), self.sum))
+        samples.append(('_count', (), total))
+        return samples
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _child(self):
+        return _Value(self.registry.lock)
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _child(self):
+        return _GaugeValue(self.registry.lock)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames, buckets):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _child(self):
+        return _HistogramValue(self.registry.lock, self.buckets)
+
+
+def render(snapshots):
+    # snapshots is a list of (extra labels, registry snapshot). Series of
+    # the same metric from every snapshot go under one HELP/TYPE header.
+    metrics = {}
+    for extra, snapshot in snapshots:
+        extra = tuple(extra.items())
+        for name, kind, documentation, samples in snapshot:
+            if name not in metrics:
+                metrics[name] = (kind, documentation, [])
+            metrics[name][2].extend((sample, extra + labels, value) for sample, labels, value in samples)
+
+    lines = []
+    for name, (kind, documentation, samples) in metrics.items():
+        lines.append(f"# HELP {name} {documentation}")
+        lines.append(f"# TYPE {name} {kind}")
+        for sample, labels, value in samples:
+            if labels:
+                pairs = ",".join(f'{key}="{_escape(value)}"' for key, value in labels)
+                lines.append(f"{sample}{{{pairs}}} {_format(value)}")
+            else:
+                lines.append(f"{sample} {_format(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def serve(port, collect):
+    # Serves GET /metrics on a daemon thread. collect() returns the text.
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = collect().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes are not worth a log line each
+            pass
+
+    server = http.server.ThreadingHTTPServer(("", port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -1,33 +1,318 @@
-import pika
+import collections
+import hashlib
+import itertools
+import os
+import threading
 import time
 
-QUEUE_NAME = 'test'
+import pika
+
+from shared import codec, retry
+from shared.sensors.schemas import SensorDataMessage
+
+# Readings are published once to a fanout exchange that copies them into a
+# durable queue per database, so every sink is consumed at its own pace
+EXCHANGE_NAME = 'sensor_data'
+SINK_QUEUES = {
+    'redis': 'sensor_data.redis',
+    'timescale': 'sensor_data.timescale',
+    'cassandra': 'sensor_data.cassandra',
+}
+# Sensors created or deleted, every API replica (and the consumers that keep
+# sensor metadata) binds its own temporary queue to it. The sinks that follow
+# the sensors themselves get a durable queue each.
+SENSOR_EVENTS_EXCHANGE = 'sensor_events'
+EVENT_QUEUES = {
+    'elasticsearch': 'sensor_events.elasticsearch',
+}
+
+# Messages a durable queue holds before the broker starts rejecting new
+# ones. With publisher confirms the rejection reaches the API as a nack, so
+# a backlog turns into failed requests instead of a broker that runs out of
+# memory and blocks every connection.
+QUEUE_MAX_LENGTH = int(os.environ.get("QUEUE_MAX_LENGTH", 1000000))
+
+# Seconds a caller waits for the broker to confirm its message
+PUBLISH_TIMEOUT = float(os.environ.get("PUBLISH_TIMEOUT", 5))
+# Broker connections (each with its own I/O thread) per process
+PUBLISHER_CONNECTIONS = int(os.environ.get("PUBLISHER_CONNECTIONS", 2))
+RECONNECT_MIN_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+
+
+class PublishError(Exception):
+    pass
+
+
+def queue_arguments(queue):
+    # A rejected message is also dead-lettered into the queue's DLQ. Retries
+    # coming back from the delay queues (shared/retry.py) get no nack that
+    # anyone sees, without this they would be dropped silently as soon as
+    # the queue fills up. Replaying the DLQ is safe, the consumers skip
+    # readings they already wrote.
+    return {'x-max-length': QUEUE_MAX_LENGTH, 'x-overflow': 'reject-publish-dlx',
+            'x-dead-letter-exchange': '', 'x-dead-letter-routing-key': retry.dead_letter_queue(queue)}
+
+
+def queue_bindings():
+    # (queue, exchange) of every durable queue
+    return ([(queue, EXCHANGE_NAME) for queue in SINK_QUEUES.values()] +
+            [(queue, SENSOR_EVENTS_EXCHANGE) for queue in EVENT_QUEUES.values()])
+
+
+def declare_topology(channel):
+    # Blocking channel version, used by the consumers. Declaring is
+    # idempotent, whoever connects first creates the exchange and queues.
+    channel.exchange_declare(exchange=EXCHANGE_NAME, exchange_type='fanout', durable=True)
+    channel.exchange_declare(exchange=SENSOR_EVENTS_EXCHANGE, exchange_type='fanout', durable=True)
+    for queue, exchange in queue_bindings():
+        channel.queue_declare(queue=queue, durable=True, arguments=queue_arguments(queue))
+        channel.queue_bind(queue=queue, exchange=exchange)
+        # Only the consumers retry, so only they declare the delay queues
+        for retry_queue, arguments in retry.retry_queues(queue):
+            channel.queue_declare(queue=retry_queue, durable=True, arguments=arguments)
+
+
+class _Delivery:
+    def __init__(self, body, exchange, content_type=codec.JSON):
+        self.body = body
+        self.exchange = exchange
+        self.content_type = content_type
+        # Derived from the content, a reading published twice (say, after a
+        # timed out confirm) has the same id both times and the consumers
+        # keep only one
+        self.message_id = hashlib.sha1(body if isinstance(body, bytes) else body.encode()).hexdigest()
+        # Readings packed in this message
+        self.count = 1
+        self.acked = False
+        self.done = threading.Event()
+
+    def resolve(self, acked):
+        self.acked = acked
+        self.done.set()
+
 
 class Publisher:
+    # The pika connection lives in its own I/O thread. Callers append their
+    # messages to a deque, which is atomic without taking a lock, and wait
+    # until the broker confirms them. RabbitMQ acks confirms with
+    # multiple=True whenever it can, so a burst of publishes is confirmed in
+    # a handful of frames instead of one round trip per message.
 
     channel = None
     conn = None
 
     def __init__(self):
         credentials = pika.PlainCredentials('guest', 'guest')
-        parameters = pika.ConnectionParameters('rabbitmq',
+        self.parameters = pika.ConnectionParameters(os.environ.get("RABBITMQ_HOST", "rabbitmq"),
                                        5672,
                                        '/',
                                        credentials)
-        try:
-            self.conn = pika.BlockingConnection(parameters)
-        except Exception as e:
-            time.sleep(10)
-            self.conn = pika.BlockingConnection(parameters)
+        self._outbox = collections.deque()
+        self._drain_scheduled = False
+        self._unconfirmed = collections.OrderedDict()
+        self._next_tag = 1
+        self._ready = threading.Event()
+        self._connected_once = False
+        self._closing = False
+
+        self._thread = threading.Thread(target=self._run, name="publisher-io", daemon=True)
+        self._thread.start()
+
+    def publish(self, message, timeout=PUBLISH_TIMEOUT, exchange=EXCHANGE_NAME):
+        self._wait_ready(timeout)
+
+        delivery, = self._deliveries([message], exchange)
+        self._outbox.append(delivery)
+        self._wakeup()
+
+        if not delivery.done.wait(timeout):
+            raise PublishError("Timed out waiting for the broker to confirm the message")
+        if not delivery.acked:
+            raise PublishError("The broker did not accept the message")
+
+    def publish_many(self, messages, timeout=PUBLISH_TIMEOUT, exchange=EXCHANGE_NAME):
+        # Queues all the messages with a single wakeup of the I/O thread and
+        # returns, in order, whether the broker confirmed each one within
+        # the timeout. Readings may share an AMQP message, see shared/codec.py.
+        self._wait_ready(timeout)
 
-        self.channel = self.conn.channel()
-        self.channel.queue_declare(queue=QUEUE_NAME)
+        deliveries = self._deliveries(messages, exchange)
+        self._outbox.extend(deliveries)
+        self._wakeup()
 
+        deadline = time.monotonic() + timeout
+        confirmed = []
+        for delivery in deliveries:
+            delivery.done.wait(max(0, deadline - time.monotonic()))
+            confirmed += [delivery.done.is_set() and delivery.acked] * delivery.count
+        return confirmed
+
+    @staticmethod
+    def _deliveries(messages, exchange):
+        if messages and all(isinstance(message, SensorDataMessage) for message in messages):
+            deliveries = []
+            for chunk in codec.chunks(messages):
+                delivery = _Delivery(codec.encode(chunk), exchange, codec.WIRE_FORMAT)
+                delivery.count = len(chunk)
+                deliveries.append(delivery)
+            return deliveries
+        return [_Delivery(message.to_json(), exchange) for message in messages]
+
+    def _wait_ready(self, timeout):
+        # Until the first connection is up requests wait for it, afterwards
+        # they fail straight away while the I/O thread reconnects
+        if not self._ready.is_set():
+            if self._connected_once or not self._ready.wait(timeout):
+                raise PublishError("The broker is not available")
 
-    
-    def publish(self, message):
-        self.channel.basic_publish(exchange='', routing_key=QUEUE_NAME, body=message.to_json())
-        print(" [x] Sent %r" % message)
-    
     def close(self):
-        self.conn.close()
+        self._closing = True
+        if self.conn is not None:
+            self.conn.ioloop.add_callback_threadsafe(self.conn.close)
+        self._thread.join()
+
+    def _wakeup(self):
+        # One pending drain empties the whole outbox, so the I/O loop is only
+        # woken up if none is scheduled yet
+        if not self._drain_scheduled and self._ready.is_set():
+            self._drain_scheduled = True
+            self.conn.ioloop.add_callback_threadsafe(self._drain)
+
+    def _run(self):
+        delay = RECONNECT_MIN_DELAY
+        while not self._closing:
+            self._opened = False
+            self.conn = pika.SelectConnection(self.parameters,
+                                              on_open_callback=self._on_connection_open,
+                                              on_open_error_callback=self._on_connection_closed,
+                                              on_close_callback=self._on_connection_closed)
+            self.conn.ioloop.start()
+            if self._opened:
+                delay = RECONNECT_MIN_DELAY
+            if not self._closing:
+                time.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    def _on_connection_open(self, conn):
+        conn.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_closed(self, conn, reason):
+        self._ready.clear()
+        self.channel = None
+        # Whatever was in flight on the old channel will never be confirmed,
+        # and what is still waiting in the outbox fails fast as well
+        for delivery in self._unconfirmed.values():
+            delivery.resolve(False)
+        self._unconfirmed.clear()
+        self._next_tag = 1
+        while self._outbox:
+            self._outbox.popleft().resolve(False)
+        self._drain_scheduled = False
+        conn.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        self.channel = channel
+        channel.add_on_close_callback(self._on_channel_closed)
+        # pika queues each RPC until the previous one is answered, so only
+        # the last bind needs a callback. The sink queues are declared here
+        # too, otherwise readings published before the consumers start would
+        # be dropped by the exchange, and so are their DLQs, where overflow
+        # goes.
+        channel.confirm_delivery(self._on_delivery_confirmation)
+        channel.exchange_declare(exchange=EXCHANGE_NAME, exchange_type='fanout', durable=True)
+        channel.exchange_declare(exchange=SENSOR_EVENTS_EXCHANGE, exchange_type='fanout', durable=True)
+        bindings = queue_bindings()
+        for queue, exchange in bindings:
+            channel.queue_declare(queue=retry.dead_letter_queue(queue), durable=True)
+            channel.queue_declare(queue=queue, durable=True, arguments=queue_arguments(queue))
+            channel.queue_bind(queue=queue, exchange=exchange,
+                               callback=self._on_topology_declared if queue == bindings[-1][0] else None)
+
+    def _on_channel_closed(self, channel, reason):
+        # The broker closes the channel when a declare fails, for instance a
+        # sink queue that exists with other queue_arguments. The connection
+        # is closed as well, so _run reconnects with its backoff instead of
+        # leaving every publish to time out.
+        self.channel = None
+        if self._closing:
+            return
+        print("The publisher channel was closed:", reason)
+        if self.conn.is_open:
+            self.conn.close()
+
+    def _on_topology_declared(self, frame):
+        self._opened = True
+        self._connected_once = True
+        self._ready.set()
+        self._drain()
+
+    def _drain(self):
+        self._drain_scheduled = False
+        if self.channel is None:
+            return
+        while self._outbox:
+            delivery = self._outbox.popleft()
+            self.channel.basic_publish(exchange=delivery.exchange, routing_key='', body=delivery.body,
+                                       properties=pika.BasicProperties(content_type=delivery.content_type,
+                                                                       message_id=delivery.message_id, delivery_mode=2))
+            self._unconfirmed[self._next_tag] = delivery
+            self._next_tag += 1
+
+    def _on_delivery_confirmation(self, frame):
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        if not method.multiple:
+            delivery = self._unconfirmed.pop(method.delivery_tag, None)
+            if delivery is not None:
+                delivery.resolve(acked)
+            return
+        while self._unconfirmed:
+            tag = next(iter(self._unconfirmed))
+            if tag > method.delivery_tag:
+                break
+            self._unconfirmed.pop(tag).resolve(acked)
+
+
+class PublisherPool:
+    # Spreads the request threads over a few Publisher connections. Each
+    # thread sticks to the connection it was first given, so the messages of
+    # one thread keep their order.
+
+    def __init__(self, size=PUBLISHER_CONNECTIONS):
+        self.publishers = [Publisher() for _ in range(size)]
+        self._assign = itertools.cycle(self.publishers)
+        self._local = threading.local()
+
+    def get(self):
+        publisher = getattr(self._local, 'publisher', None)
+        if publisher is None:
+            publisher = self._local.publisher = next(self._assign)
+        return publisher
+
+    def publish(self, message, timeout=PUBLISH_TIMEOUT, exchange=EXCHANGE_NAME):
+        return self.get().publish(message, timeout, exchange)
+
+    def publish_many(self, messages, timeout=PUBLISH_TIMEOUT, exchange=EXCHANGE_NAME):
+        return self.get().publish_many(messages, timeout, exchange)
+
+    def close(self):
+        for publisher in self.publishers:
+            publisher.close()
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_publisher_pool():
+    # One pool per process. The pid check makes a forked worker build its own
+    # pool instead of sharing the parent's sockets and I/O threads.
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = PublisherPool()
+                _pool_pid = os.getpid()
+    return _pool
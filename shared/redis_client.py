@@ -19,11 +19,32 @@ class RedisClient:
     def set(self, key, value):
         return self._client.set(key, value)
     
+    def mset(self, mapping):
+        return self._client.mset(mapping)
+
     def delete(self, key):
         return self._client.delete(key)
     
     def keys(self, pattern):
         return self._client.keys(pattern)
+
+    def smembers(self, key):
+        return self._client.smembers(key)
+
+    def zadd(self, key, mapping, gt=False):
+        return self._client.zadd(key, mapping, gt=gt)
+
+    def zmscore(self, key, members):
+        return self._client.zmscore(key, members)
+
+    def exists(self, key):
+        return self._client.exists(key)
+
+    def pipeline(self, transaction=True):
+        return self._client.pipeline(transaction=transaction)
+
+    def register_script(self, script):
+        return self._client.register_script(script)
     
     def clearAll(self):
         for key in self._client.keys("*"):
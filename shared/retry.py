@@ -0,0 +1,84 @@
+import os
+import sys
+
+import pika
+
+# A batch that fails to be written is not requeued in place, where it would
+# be redelivered straight away and hold up the messages behind it. Each of
+# its messages is published to a delay queue picked by how many times it
+# has failed. The delay queue has no consumers: the message waits out the
+# queue TTL and is dead-lettered back into its sink queue. After the last
+# delay it is parked in the sink's DLQ until someone replays it.
+RETRY_DELAYS = [int(delay) for delay in os.environ.get("CONSUMER_RETRY_DELAYS", "1,10,60").split(",")]
+ATTEMPT_HEADER = 'x-attempt'
+# Before that, a failed batch is written again in halves, down to single
+# messages, so one bad reading does not take the rest of its batch through
+# the delay queues. This bounds the extra writes when every one fails (the
+# database is down): whatever is left unwritten then moves on as is.
+SPLIT_ATTEMPTS = int(os.environ.get("CONSUMER_SPLIT_ATTEMPTS", 32))
+
+
+def retry_queue(queue, delay):
+    return f"{queue}.retry.{delay}s"
+
+
+def dead_letter_queue(queue):
+    return f"{queue}.dlq"
+
+
+def retry_queues(queue):
+    # (name, arguments) of the delay queues and the DLQ of a sink queue
+    queues = [(retry_queue(queue, delay), {'x-message-ttl': delay * 1000,
+                                            'x-dead-letter-exchange': '',
+                                            'x-dead-letter-routing-key': queue})
+              for delay in RETRY_DELAYS]
+    queues.append((dead_letter_queue(queue), {}))
+    return queues
+
+
+def attempts(headers):
+    return int((headers or {}).get(ATTEMPT_HEADER, 0))
+
+
+def next_queue(queue, attempt):
+    # Where a message goes after failing for the `attempt`th time
+    if attempt <= len(RETRY_DELAYS):
+        return retry_queue(queue, RETRY_DELAYS[attempt - 1])
+    return dead_letter_queue(queue)
+
+
+def retry_headers(headers):
+    return {**(headers or {}), ATTEMPT_HEADER: attempts(headers) + 1}
+
+
+def replay(channel, queue, limit=None):
+    # Moves the messages parked in the DLQ of `queue` back into it with their
+    # attempt count reset. Each one is acked only once the broker confirmed
+    # its copy, so an interrupted replay loses nothing.
+    channel.confirm_delivery()
+    replayed = 0
+    while limit is None or replayed < limit:
+        method, properties, body = channel.basic_get(queue=dead_letter_queue(queue), auto_ack=False)
+        if method is None:
+            break
+        headers = dict(properties.headers or {})
+        headers.pop(ATTEMPT_HEADER, None)
+        channel.basic_publish(exchange='', routing_key=queue, body=body,
+                              properties=pika.BasicProperties(content_type=properties.content_type,
+                                                              message_id=properties.message_id,
+                                                              headers=headers, delivery_mode=2))
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+        replayed += 1
+    return replayed
+
+
+if __name__ == "__main__":
+    # python -m shared.retry replay <sink queue> [max messages]
+    if len(sys.argv) < 3 or sys.argv[1] != "replay":
+        sys.exit("usage: python -m shared.retry replay <sink queue> [max messages]")
+    credentials = pika.PlainCredentials('guest', 'guest')
+    conn = pika.BlockingConnection(pika.ConnectionParameters(os.environ.get("RABBITMQ_HOST", "localhost"),
+                                                             5672, '/', credentials))
+    count = replay(conn.channel(), sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else None)
+    print("Replayed", count, "messages into", sys.argv[2])
+    conn.close()
@@ -0,0 +1,120 @@
+import os
+import sys
+import time
+
+# Sensors are searched through this name. It is an alias once the index has
+# been rebuilt with `reindex`, before that it may still be a plain index.
+INDEX_NAME = 'index_sensors'
+# How often new documents become searchable. The consumer indexes in bulk,
+# so refreshing less often than once per write is what keeps it cheap.
+REFRESH_INTERVAL = os.environ.get("ES_REFRESH_INTERVAL", "1s")
+REINDEX_BATCH_SIZE = 1000
+
+MAPPING = {
+    'properties': {
+        'id': {'type': 'integer'},
+        'name': {'type': 'text', 'fields': {'keyword': {'type': 'keyword'}}},
+        'description': {'type': 'text'},
+        'type': {'type': 'text'}
+    }
+}
+
+
+def ensure_index(es, index_name=INDEX_NAME):
+    # Idempotent, the mapping is put again in case the index predates a field
+    if not es.index_exists(index_name):
+        es.create_index(index_name, settings={'refresh_interval': REFRESH_INTERVAL})
+    es.create_mapping(index_name, MAPPING)
+
+
+def document(sensor):
+    # The searchable fields of a sensor document from mongo
+    return {
+        'id': sensor['id'],
+        'name': sensor['name'],
+        'description': sensor.get('description'),
+        'type': sensor.get('type'),
+    }
+
+
+def index_action(sensor, index_name=INDEX_NAME):
+    return [{'index': {'_index': index_name, '_id': sensor['id']}}, document(sensor)]
+
+
+def delete_action(sensor_id, index_name=INDEX_NAME):
+    return [{'delete': {'_index': index_name, '_id': sensor_id}}]
+
+
+def legacy_delete_query(names):
+    # Documents indexed before they carried the sensor id have a generated
+    # _id, so delete_action misses them. They are found by exact name.
+    return {
+        'bool': {
+            'filter': [{'terms': {'name.keyword': names}}],
+            'must_not': [{'exists': {'field': 'id'}}],
+        }
+    }
+
+
+def check_bulk(response):
+    # Deleting a document that is not there is fine, anything else is not
+    if not response['errors']:
+        return
+    for item in response['items']:
+        (action, result), = item.items()
+        if 'error' in result and not (action == 'delete' and result.get('status') == 404):
+            raise RuntimeError(f"Bulk {action} of {result.get('_id')} failed: {result['error']}")
+
+
+def reindex(es, mongodb):
+    # Copies every sensor in mongo into a new index and then points the
+    # alias at it in one atomic update, searches never see a missing or half
+    # built index. Sensors created or deleted while the copy runs reach the
+    # old index only, run it again if that matters.
+    new_index = f"{INDEX_NAME}_{int(time.time())}"
+    # No refreshes and no replicas while loading, both come back at the end
+    es.create_index(new_index, settings={'refresh_interval': '-1', 'number_of_replicas': 0})
+    es.create_mapping(new_index, MAPPING)
+
+    mongodb.getDatabase("mydatabase")
+    sensors = mongodb.getCollection("sensors").find({}, {'_id': 0, 'id': 1, 'name': 1, 'description': 1, 'type': 1})
+    copied = 0
+    operations = []
+    for sensor in sensors.batch_size(REINDEX_BATCH_SIZE):
+        operations += index_action(sensor, new_index)
+        copied += 1
+        if len(operations) >= 2 * REINDEX_BATCH_SIZE:
+            check_bulk(es.bulk(operations))
+            operations = []
+    if operations:
+        check_bulk(es.bulk(operations))
+
+    es.put_settings(new_index, {'refresh_interval': REFRESH_INTERVAL, 'number_of_replicas': 1})
+    es.refresh(new_index)
+
+    old_indices = list(es.get_alias(INDEX_NAME)) if es.alias_exists(INDEX_NAME) else []
+    actions = [{'remove': {'index': index, 'alias': INDEX_NAME}} for index in old_indices]
+    if not old_indices and es.index_exists(INDEX_NAME):
+        # The first reindex replaces the plain index with the alias
+        actions.append({'remove_index': {'index': INDEX_NAME}})
+    actions.append({'add': {'index': new_index, 'alias': INDEX_NAME}})
+    es.update_aliases(actions)
+
+    for index in old_indices:
+        es.delete_index(index)
+    return new_index, copied
+
+
+if __name__ == "__main__":
+    # python -m shared.search_index reindex [mongodb host] [elasticsearch host]
+    from shared.elasticsearch_client import ElasticsearchClient
+    from shared.mongodb_client import MongoDBClient
+
+    if len(sys.argv) < 2 or sys.argv[1] != "reindex":
+        sys.exit("usage: python -m shared.search_index reindex [mongodb host] [elasticsearch host]")
+    mongodb = MongoDBClient(host=sys.argv[2] if len(sys.argv) > 2 else "mongodb")
+    es = ElasticsearchClient(host=sys.argv[3] if len(sys.argv) > 3 else "elasticsearch")
+    index, copied = reindex(es, mongodb)
+    print("Copied", copied, "sensors to", index)
+    es.close()
+    mongodb.close()
@@ -0,0 +1,178 @@
+import collections
+import os
+import threading
+import time
+
+import pika
+
+from shared.publisher import RECONNECT_MAX_DELAY, RECONNECT_MIN_DELAY, SENSOR_EVENTS_EXCHANGE
+from shared.sensors.schemas import SensorEvent
+
+# Sensor metadata barely changes, but it is read on every reading posted and
+# every data request. Each process keeps the documents it has seen in a
+# bounded LRU cache, and evicts them when a sensor_events message says the
+# sensor was created or deleted. The TTL bounds how stale an entry can get
+# while the broker is unreachable and events are missed.
+CACHE_SIZE = int(os.environ.get("SENSOR_CACHE_SIZE", 10000))
+CACHE_TTL = float(os.environ.get("SENSOR_CACHE_TTL", 300))
+
+
+class SensorCache:
+    def __init__(self, max_size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by every invalidation, so a document loaded before an
+        # invalidation is not cached after it
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, sensor_id, load):
+        # Returns a copy of the cached document, or calls load(sensor_id) and
+        # caches what it returns. Missing sensors are not cached.
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(sensor_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(sensor_id)
+                self.hits += 1
+                return dict(entry[1])
+            self.misses += 1
+            generation = self._generation
+
+        doc = load(sensor_id)
+        if doc is None:
+            return None
+
+        with self._lock:
+            if generation == self._generation:
+                self._entries[sensor_id] = (now + self.ttl, dict(doc))
+                self._entries.move_to_end(sensor_id)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return doc
+
+    def get_many(self, sensor_ids, load_many):
+        # Like get for several sensors, the ones not cached are loaded with a
+        # single load_many(ids) call that returns {id: document}
+        now = time.monotonic()
+        found, missing = {}, []
+        with self._lock:
+            for sensor_id in set(sensor_ids):
+                entry = self._entries.get(sensor_id)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(sensor_id)
+                    self.hits += 1
+                    found[sensor_id] = dict(entry[1])
+                else:
+                    self.misses += 1
+                    missing.append(sensor_id)
+            generation = self._generation
+        if not missing:
+            return found
+
+        loaded = load_many(missing)
+        with self._lock:
+            if generation == self._generation:
+                for sensor_id, doc in loaded.items():
+                    self._entries[sensor_id] = (now + self.ttl, dict(doc))
+                    self._entries.move_to_end(sensor_id)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        found.update(loaded)
+        return found
+
+    def invalidate(self, sensor_id):
+        with self._lock:
+            self._generation += 1
+            self.invalidations += 1
+            self._entries.pop(sensor_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+class SensorEventListener:
+    # Consumes sensor_events in its own thread through an exclusive queue,
+    # so every process gets every event. Whatever was cached is dropped on
+    # each (re)connect, events sent while disconnected are lost.
+
+    def __init__(self, cache):
+        credentials = pika.PlainCredentials('guest', 'guest')
+        self.parameters = pika.ConnectionParameters(os.environ.get("RABBITMQ_HOST", "rabbitmq"),
+                                       5672,
+                                       '/',
+                                       credentials)
+        self.cache = cache
+        self.conn = None
+        self.channel = None
+        self._closing = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sensor-events", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._closing.set()
+        conn, channel = self.conn, self.channel
+        if conn is not None and channel is not None:
+            try:
+                conn.add_callback_threadsafe(channel.stop_consuming)
+            except pika.exceptions.AMQPError:
+                pass
+        self._thread.join(5)
+
+    def _run(self):
+        delay = RECONNECT_MIN_DELAY
+        while not self._closing.is_set():
+            try:
+                self.conn = pika.BlockingConnection(self.parameters)
+                self.channel = self.conn.channel()
+                self.channel.exchange_declare(exchange=SENSOR_EVENTS_EXCHANGE, exchange_type='fanout', durable=True)
+                queue = self.channel.queue_declare(queue='', exclusive=True).method.queue
+                self.channel.queue_bind(queue=queue, exchange=SENSOR_EVENTS_EXCHANGE)
+                self.channel.basic_consume(queue=queue, on_message_callback=self._on_event, auto_ack=True)
+                self.cache.clear()
+                delay = RECONNECT_MIN_DELAY
+                if not self._closing.is_set():
+                    self.channel.start_consuming()
+            except pika.exceptions.AMQPError as e:
+                print("Sensor events connection lost:", e)
+            finally:
+                self.cache.clear()
+                if self.conn is not None and self.conn.is_open:
+                    self.conn.close()
+                self.conn = self.channel = None
+            self._closing.wait(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    def _on_event(self, channel, method, properties, body):
+        self.cache.invalidate(SensorEvent.parse_raw(body).sensor_id)
+
+
+_cache = SensorCache()
+
+
+def get_sensor_cache():
+    return _cache
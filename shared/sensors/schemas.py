@@ -1,4 +1,6 @@
-from pydantic import BaseModel
+from datetime import datetime
+from pydantic import BaseModel, validator
+from typing import Optional
 
 class Sensor(BaseModel):
     id: int
@@ -31,8 +33,37 @@ class SensorCreate(BaseModel):
     firmware_version: str
 
 class SensorData(BaseModel):
-    velocity: float
-    temperature: float
-    humidity: float
+    velocity: Optional[float] = None
+    temperature: Optional[float] = None
+    humidity: Optional[float] = None
     battery_level: float
-    last_seen: str
\ No newline at end of file
+    last_seen: str
+
+    @validator('last_seen')
+    def last_seen_is_iso_8601(cls, value):
+        # Kept as sent, but it must parse: the consumers write it later,
+        # after the request has been answered
+        try:
+            datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError("last_seen must be an ISO 8601 date and time")
+        return value
+
+class SensorDataMessage(SensorData):
+    sensor_id: int
+
+    def reading(self) -> SensorData:
+        return SensorData(**self.dict(exclude={'sensor_id'}))
+
+    def to_json(self) -> str:
+        return self.json()
+
+class SensorEvent(BaseModel):
+    # Published on the sensor_events exchange when a sensor is created or
+    # deleted. Created events carry the sensor document.
+    event: str
+    sensor_id: int
+    sensor: Optional[dict] = None
+
+    def to_json(self) -> str:
+        return self.json()
@@ -1,13 +1,30 @@
+import collections
+import os
+import signal
+import traceback
+
 import pika
 import time
 
-from shared.publisher import QUEUE_NAME
+from shared import retry
+from shared.publisher import declare_topology
+
+# What on_batch gets for each message
+Delivery = collections.namedtuple('Delivery', ['message_id', 'content_type', 'body'])
+
+# A batch is flushed when it reaches BATCH_SIZE messages or FLUSH_INTERVAL
+# seconds after its first message arrived, whichever comes first
+BATCH_SIZE = int(os.environ.get("CONSUMER_BATCH_SIZE", 500))
+FLUSH_INTERVAL = int(os.environ.get("CONSUMER_FLUSH_INTERVAL_MS", 200)) / 1000
+# Unacked messages the broker lets this consumer hold, set per sink group
+PREFETCH = int(os.environ.get("CONSUMER_PREFETCH", BATCH_SIZE * 2))
+
 
 class Subscriber:
     def __init__(self):
         credentials = pika.PlainCredentials('guest', 'guest')
         # Change the host to rabbitmq
-        parameters = pika.ConnectionParameters('localhost',
+        parameters = pika.ConnectionParameters(os.environ.get("RABBITMQ_HOST", "localhost"),
                                        5672,
                                        '/',
                                        credentials)
@@ -17,14 +34,118 @@ class Subscriber:
             time.sleep(10)
             self.conn = pika.BlockingConnection(parameters)
         self.channel = self.conn.channel()
+        self._batch = []
+        self._timer = None
 
 
-    def subscribe(self, callback):
-        result = self.channel.queue_declare(queue=QUEUE_NAME)
-        self.channel.basic_consume(queue=QUEUE_NAME, on_message_callback=callback, auto_ack=True)
+    def subscribe(self, queue, callback):
+        declare_topology(self.channel)
+        self.channel.basic_consume(queue=queue, on_message_callback=callback, auto_ack=True)
         self.channel.start_consuming()
 
+    def subscribe_batch(self, queue, on_batch, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, prefetch=PREFETCH):
+        # on_batch receives the list of Delivery and must have
+        # written them when it returns, the whole batch is acked right after.
+        # If it raises, the batch is written again in parts (split=True, its
+        # messages were already counted) and the messages that still fail go
+        # to their delay queue (shared/retry.py).
+        self._queue = queue
+        self._on_batch = on_batch
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+
+        declare_topology(self.channel)
+        # Confirms make the retry publishes safe to ack the originals after
+        self.channel.confirm_delivery()
+        self.channel.basic_qos(prefetch_count=max(prefetch, batch_size))
+        self.channel.basic_consume(queue=queue, on_message_callback=self._on_message, auto_ack=False)
+        signal.signal(signal.SIGTERM, self._on_sigterm)
+        try:
+            self.channel.start_consuming()
+        except KeyboardInterrupt:
+            self.channel.stop_consuming()
+        finally:
+            self.flush()
+
+    def _on_message(self, ch, method, properties, body):
+        self._batch.append((method.delivery_tag, properties, body))
+        if len(self._batch) >= self._batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self.conn.call_later(self._flush_interval, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self.flush()
+
+    def _on_sigterm(self, signum, frame):
+        # Leave start_consuming from the I/O loop, the pending batch is
+        # flushed on the way out of subscribe_batch
+        self.conn.add_callback_threadsafe(self.channel.stop_consuming)
+
+    def queue_depth(self, queue):
+        # Ready messages in the queue, from the consuming thread only
+        return self.channel.queue_declare(queue=queue, passive=True).method.message_count
+
+    def flush(self):
+        if self._timer is not None:
+            self.conn.remove_timeout(self._timer)
+            self._timer = None
+        if not self._batch:
+            return
+
+        batch, self._batch = self._batch, []
+        last_tag = batch[-1][0]
+        failed = self._write(batch)
+        if failed:
+            print(f"{len(failed)} of {len(batch)} messages could not be written, sending them to their delay queue")
+            try:
+                self._retry(failed)
+            except pika.exceptions.AMQPError:
+                # The delay queues cannot be reached either, put the batch
+                # back and let the broker redeliver it
+                traceback.print_exc()
+                self.channel.basic_nack(delivery_tag=last_tag, multiple=True, requeue=True)
+                return
+        self.channel.basic_ack(delivery_tag=last_tag, multiple=True)
+
+    def _write(self, batch):
+        # Writes batch and returns the messages that could not be written. A
+        # part that fails is written again in halves, in order, until single
+        # messages fail or retry.SPLIT_ATTEMPTS extra writes are spent.
+        parts = collections.deque([(batch, False)])
+        failed = []
+        attempts = 0
+        while parts:
+            part, split = parts.popleft()
+            if split:
+                if attempts == retry.SPLIT_ATTEMPTS:
+                    failed += part
+                    continue
+                attempts += 1
+            try:
+                self._on_batch([Delivery(properties.message_id, properties.content_type, body) for _, properties, body in part],
+                               split=split)
+            except Exception:
+                if not split:
+                    traceback.print_exc()
+                if len(part) == 1:
+                    failed += part
+                else:
+                    middle = len(part) // 2
+                    parts.extendleft([(part[middle:], True), (part[:middle], True)])
+        return failed
+
+    def _retry(self, batch):
+        for _, properties, body in batch:
+            headers = retry.retry_headers(properties.headers)
+            self.channel.basic_publish(exchange='', routing_key=retry.next_queue(self._queue, headers[retry.ATTEMPT_HEADER]),
+                                       body=body,
+                                       properties=pika.BasicProperties(content_type=properties.content_type,
+                                                                       message_id=properties.message_id,
+                                                                       headers=headers, delivery_mode=2))
+
     def close(self):
         self.conn.close()
 
-    
\ No newline at end of file
+    
@@ -0,0 +1,155 @@
+import sys
+from decimal import ROUND_HALF_EVEN, Decimal
+
+# Running min, max, sum and count of the temperature of each sensor, kept in
+# one redis hash per sensor by the redis consumer. /sensors/temperature/values
+# reads them back in a single round trip instead of scanning every reading.
+SENSORS_KEY = "temperature:sensors"
+# The sum is kept as an integer count of 10^-SCALE degrees and added with
+# HINCRBY, so it is the exact decimal sum of the readings, like the
+# decimal SUM and AVG of sensor.temperature_readings. Summing doubles drifts
+# (0.1 + 0.2 != 0.3). Readings with more than SCALE decimals are rounded.
+SCALE = 6
+
+# Merges the stats of a batch into the hashes. Runs atomically in redis, so
+# the consumer workers can update the same sensor at the same time.
+UPDATE_SCRIPT = """
+for i, key in ipairs(KEYS) do
+    local min, max, sum, count = ARGV[i * 4 - 3], ARGV[i * 4 - 2], ARGV[i * 4 - 1], ARGV[i * 4]
+    local current = redis.call('HMGET', key, 'min', 'max')
+    if not current[1] or tonumber(min) < tonumber(current[1]) then
+        redis.call('HSET', key, 'min', min)
+    end
+    if not current[2] or tonumber(max) > tonumber(current[2]) then
+        redis.call('HSET', key, 'max', max)
+    end
+    redis.call('HINCRBY', key, 'sum', sum)
+    redis.call('HINCRBY', key, 'count', count)
+end
+"""
+
+
+def stats_key(sensor_id):
+    # Not the temperature:stats:<id> of the float sums, a consumer adding
+    # integers to those would fail or corrupt them. Run the backfill below
+    # to build these.
+    return f"temperature:fixed:{sensor_id}"
+
+
+def to_fixed(value):
+    # The temperature in 10^-SCALE degrees. Goes through the shortest repr
+    # of a float, like consumer.sinks.to_decimal.
+    if not isinstance(value, Decimal):
+        value = Decimal(repr(value))
+    return int(value.scaleb(SCALE).to_integral_value(ROUND_HALF_EVEN))
+
+
+def from_fixed(value):
+    return Decimal(int(value)).scaleb(-SCALE)
+
+
+def aggregate(messages):
+    # {sensor_id: [min, max, fixed point sum, count]} for the readings with a
+    # temperature
+    stats = {}
+    for m in messages:
+        if m.temperature is None:
+            continue
+        if m.sensor_id not in stats:
+            stats[m.sensor_id] = [m.temperature, m.temperature, to_fixed(m.temperature), 1]
+            continue
+        sensor_stats = stats[m.sensor_id]
+        sensor_stats[0] = min(sensor_stats[0], m.temperature)
+        sensor_stats[1] = max(sensor_stats[1], m.temperature)
+        sensor_stats[2] += to_fixed(m.temperature)
+        sensor_stats[3] += 1
+    return stats
+
+
+def script_args(stats):
+    keys, args = [], []
+    for sensor_id, (min_, max_, sum_, count) in stats.items():
+        keys.append(stats_key(sensor_id))
+        args += [repr(float(min_)), repr(float(max_)), sum_, count]
+    return keys, args
+
+
+def update(script, pipe, stats):
+    # Queues the update of `stats` on a pipeline, `script` is UPDATE_SCRIPT
+    # registered on the same client
+    if not stats:
+        return
+    keys, args = script_args(stats)
+    script(keys=keys, args=args, client=pipe)
+    pipe.sadd(SENSORS_KEY, *stats)
+
+
+async def update_async(script, pipe, stats):
+    # update() for a redis.asyncio pipeline, where queueing the script is a
+    # coroutine
+    if not stats:
+        return
+    keys, args = script_args(stats)
+    await script(keys=keys, args=args, client=pipe)
+    pipe.sadd(SENSORS_KEY, *stats)
+
+
+def read(redis):
+    # {sensor_id: {"min", "max", "sum", "count"}} sorted by sensor id, the
+    # sum is an exact Decimal
+    ids = sorted(int(sensor_id) for sensor_id in redis.smembers(SENSORS_KEY))
+    pipe = redis.pipeline(transaction=False)
+    for sensor_id in ids:
+        pipe.hgetall(stats_key(sensor_id))
+
+    stats = {}
+    for sensor_id, values in zip(ids, pipe.execute()):
+        if not values:
+            continue
+        stats[sensor_id] = {
+            "min": float(values[b"min"]),
+            "max": float(values[b"max"]),
+            "sum": from_fixed(values[b"sum"]),
+            "count": int(values[b"count"]),
+        }
+    return stats
+
+
+def backfill(redis, cassandra):
+    # Rebuilds the hashes from sensor.temperature_readings. Run it with the
+    # redis consumer stopped, readings written in between would be lost.
+    query = """
+        SELECT id, MIN(temperature) AS min, MAX(temperature) AS max, SUM(temperature) AS sum, COUNT(temperature) AS count
+        FROM sensor.temperature_readings GROUP BY id, month;
+    """
+    stats = {}
+    for row in cassandra.execute(query):
+        if row.id not in stats:
+            stats[row.id] = [row.min, row.max, to_fixed(row.sum), row.count]
+            continue
+        sensor_stats = stats[row.id]
+        sensor_stats[0] = min(sensor_stats[0], row.min)
+        sensor_stats[1] = max(sensor_stats[1], row.max)
+        sensor_stats[2] += to_fixed(row.sum)
+        sensor_stats[3] += row.count
+
+    pipe = redis.pipeline(transaction=True)
+    for sensor_id, (min_, max_, sum_, count) in stats.items():
+        pipe.delete(stats_key(sensor_id))
+        pipe.hset(stats_key(sensor_id), mapping={"min": repr(float(min_)), "max": repr(float(max_)), "sum": sum_, "count": count})
+    if stats:
+        pipe.sadd(SENSORS_KEY, *stats)
+    pipe.execute()
+    return len(stats)
+
+
+if __name__ == "__main__":
+    # python -m shared.temperature_stats [redis host] [cassandra host]
+    from shared.cassandra_client import CassandraClient
+    from shared.redis_client import RedisClient
+
+    redis = RedisClient(host=sys.argv[1] if len(sys.argv) > 1 else "redis")
+    cassandra = CassandraClient(hosts=[sys.argv[2] if len(sys.argv) > 2 else "cassandra"])
+    print("Backfilled the temperature stats of", backfill(redis, cassandra), "sensors")
+    cassandra.close()
+    redis.close()
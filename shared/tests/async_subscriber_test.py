@@ -0,0 +1,58 @@
+import asyncio
+
+from shared.async_subscriber import _Batcher
+
+
+class FakeMessage:
+    def __init__(self, tag):
+        self.delivery_tag = tag
+        self.message_id = f"id{tag}"
+        self.content_type = "application/json"
+        self.body = f"body{tag}".encode()
+        self.headers = {}
+        self.settled = []
+
+    async def ack(self, multiple=False):
+        self.settled.append(("ack", multiple))
+
+    async def nack(self, multiple=False, requeue=True):
+        self.settled.append(("nack", multiple, requeue))
+
+
+class FakeExchange:
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, message, routing_key):
+        self.published.append((routing_key, message.body))
+
+
+class FakeChannel:
+    def __init__(self):
+        self.default_exchange = FakeExchange()
+
+
+def test_only_the_bad_message_of_a_failed_batch_is_retried():
+    written, calls = [], []
+
+    async def on_batch(deliveries, split=False):
+        calls.append(split)
+        if any(delivery.body == b"body2" for delivery in deliveries):
+            raise ValueError("bad reading")
+        written.extend(delivery.body for delivery in deliveries)
+
+    async def run():
+        channel = FakeChannel()
+        batcher = _Batcher(on_batch, 3, 0.2, 1, channel, "q")
+        messages = [FakeMessage(tag) for tag in (1, 2, 3)]
+        for message in messages:
+            await batcher.on_message(message)
+        await batcher.drain()
+        return channel, messages
+
+    channel, messages = asyncio.run(run())
+    assert written == [b"body1", b"body3"]
+    # [1, 2, 3], then [1] and [2, 3], then [2] and [3]
+    assert calls == [False, True, True, True, True]
+    assert channel.default_exchange.published == [("q.retry.1s", b"body2")]
+    assert messages[-1].settled == [("ack", True)]
@@ -0,0 +1,44 @@
+import msgpack
+import pytest
+
+from shared import codec
+from shared.sensors.schemas import SensorDataMessage
+
+ROW = [1, 10.0, 20.5, None, 0.5, "2020-01-01T00:00:00.000Z"]
+
+
+def test_msgpack_round_trip():
+    message = SensorDataMessage(sensor_id=1, velocity=10, temperature=20.5, battery_level=0.5,
+                                last_seen="2020-01-01T00:00:00.000Z")
+    body = codec.encode([message, message], codec.MSGPACK)
+    assert codec.decode(body, codec.MSGPACK) == [message, message]
+
+
+def test_from_row_accepts_ints_for_floats():
+    message = codec.from_row([1, 10, None, None, 1, "2020-01-01T00:00:00.000Z"])
+    assert message.velocity == 10.0 and type(message.velocity) is float
+    assert message.battery_level == 1.0 and type(message.battery_level) is float
+
+
+@pytest.mark.parametrize("row", [
+    ROW[:-1],
+    ROW + [None],
+    ("1",) + tuple(ROW[1:]),
+    ["1"] + ROW[1:],
+    [True] + ROW[1:],
+    [1.0] + ROW[1:],
+    ROW[:4] + [None] + ROW[5:],
+    ROW[:2] + ["20.5"] + ROW[3:],
+    ROW[:5] + [1577836800],
+    {"sensor_id": 1},
+])
+def test_from_row_rejects(row):
+    with pytest.raises(ValueError):
+        codec.from_row(row)
+
+
+@pytest.mark.parametrize("body", [b"\x05", b"\xc1", msgpack.packb({"a": 1}), msgpack.packb("abc"),
+                                  msgpack.packb([ROW[:-1]])])
+def test_decode_rejects_invalid_msgpack(body):
+    with pytest.raises(ValueError):
+        codec.decode(body, codec.MSGPACK)
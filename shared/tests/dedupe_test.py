@@ -0,0 +1,25 @@
+from shared.dedupe import ID_LENGTH, Deduplicator
+from shared.subscriber import Delivery
+
+
+def delivery(message_id):
+    return Delivery(message_id, None, b"")
+
+
+def test_filter_drops_seen_and_in_batch_copies():
+    # No redis is reached, the client only connects on its first command
+    dedupe = Deduplicator("q", host="localhost")
+    a, b, c = "a" * 40, "b" * 40, "c" * 40
+    deliveries = [delivery(a), delivery(b), delivery(a), delivery(None), delivery(c), delivery(None)]
+    # b was written in an earlier batch
+    fresh = dedupe._filter(deliveries, dedupe._found([0, 1, 0, 0], [0, 0, 0, 0]))
+    assert fresh == [deliveries[0], deliveries[3], deliveries[4], deliveries[5]]
+    assert dedupe.skipped == 2
+
+
+def test_found_in_either_window():
+    assert Deduplicator._found([1, 0, 0], [0, 1, 0]) == [True, True, False]
+
+
+def test_ids_are_truncated():
+    assert Deduplicator._ids([delivery("a" * 40), delivery(None)]) == ["a" * ID_LENGTH]
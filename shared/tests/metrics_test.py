@@ -0,0 +1,44 @@
+from shared import metrics
+
+
+def test_render():
+    registry = metrics.Registry()
+    requests = registry.counter('requests_total', 'Requests served', ['path'])
+    depth = registry.gauge('queue_depth', 'Ready messages')
+    latency = registry.histogram('latency_seconds', 'Time to answer', buckets=(0.5, 0.1))
+    requests.labels('/a"b\\c\n').inc(2)
+    requests.labels(path='/d').inc()
+    depth.labels().set(1.5)
+    latency.labels().observe(0.1)
+    latency.labels().observe(0.3)
+    latency.labels().observe(2)
+
+    assert metrics.render([({'worker': '0'}, registry.snapshot())]) == (
+        '# HELP requests_total Requests served\n'
+        '# TYPE requests_total counter\n'
+        'requests_total{worker="0",path="/a\\"b\\\\c\\n"} 2\n'
+        'requests_total{worker="0",path="/d"} 1\n'
+        '# HELP queue_depth Ready messages\n'
+        '# TYPE queue_depth gauge\n'
+        'queue_depth{worker="0"} 1.5\n'
+        '# HELP latency_seconds Time to answer\n'
+        '# TYPE latency_seconds histogram\n'
+        'latency_seconds_bucket{worker="0",le="0.1"} 1\n'
+        'latency_seconds_bucket{worker="0",le="0.5"} 2\n'
+        'latency_seconds_bucket{worker="0",le="+Inf"} 3\n'
+        'latency_seconds_sum{worker="0"} 2.4\n'
+        'latency_seconds_count{worker="0"} 3\n'
+    )
+
+
+def test_render_merges_snapshots_under_one_header():
+    registry = metrics.Registry()
+    registry.counter('messages_total', 'Messages').labels().inc()
+    body = metrics.render([({'worker': '0'}, registry.snapshot()), ({'worker': '1'}, registry.snapshot())])
+    assert body == (
+        '# HELP messages_total Messages\n'
+        '# TYPE messages_total counter\n'
+        'messages_total{worker="0"} 1\n'
+        'messages_total{worker="1"} 1\n'
+    )
+    assert metrics.render([({}, registry.snapshot())]).endswith('\nmessages_total 1\n')
@@ -0,0 +1,27 @@
+from shared import retry
+
+
+def test_next_queue_tiers(monkeypatch):
+    monkeypatch.setattr(retry, "RETRY_DELAYS", [1, 10, 60])
+    assert retry.next_queue("sensor_data.redis", 1) == "sensor_data.redis.retry.1s"
+    assert retry.next_queue("sensor_data.redis", 2) == "sensor_data.redis.retry.10s"
+    assert retry.next_queue("sensor_data.redis", 3) == "sensor_data.redis.retry.60s"
+    assert retry.next_queue("sensor_data.redis", 4) == "sensor_data.redis.dlq"
+    assert retry.next_queue("sensor_data.redis", 10) == "sensor_data.redis.dlq"
+
+
+def test_retry_queues_dead_letter_back_into_the_sink_queue(monkeypatch):
+    monkeypatch.setattr(retry, "RETRY_DELAYS", [1, 10])
+    assert retry.retry_queues("q") == [
+        ("q.retry.1s", {'x-message-ttl': 1000, 'x-dead-letter-exchange': '', 'x-dead-letter-routing-key': 'q'}),
+        ("q.retry.10s", {'x-message-ttl': 10000, 'x-dead-letter-exchange': '', 'x-dead-letter-routing-key': 'q'}),
+        ("q.dlq", {}),
+    ]
+
+
+def test_retry_headers_count_attempts():
+    headers = retry.retry_headers(None)
+    assert retry.attempts(headers) == 1
+    headers = retry.retry_headers({**headers, "other": "kept"})
+    assert headers == {"other": "kept", retry.ATTEMPT_HEADER: 2}
+    assert retry.attempts(None) == 0
@@ -0,0 +1,17 @@
+import pytest
+from pydantic import ValidationError
+
+from shared.sensors.schemas import SensorData, SensorDataMessage
+
+
+@pytest.mark.parametrize("last_seen", ["2020-01-01T00:00:00.000Z", "2020-01-01T00:00:00", "2020-01-01 00:00:00+01:00"])
+def test_last_seen_is_kept_as_sent(last_seen):
+    assert SensorData(battery_level=.5, last_seen=last_seen).last_seen == last_seen
+
+
+@pytest.mark.parametrize("last_seen", ["not a date", "", "2020-13-01T00:00:00", "01/01/2020"])
+def test_last_seen_must_be_iso_8601(last_seen):
+    with pytest.raises(ValidationError):
+        SensorData(battery_level=.5, last_seen=last_seen)
+    with pytest.raises(ValidationError):
+        SensorDataMessage.parse_raw(f'{{"sensor_id": 1, "battery_level": 0.5, "last_seen": "{last_seen}"}}')
@@ -0,0 +1,83 @@
+from shared import sensor_cache
+from shared.sensor_cache import SensorCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def loader(calls):
+    def load(sensor_id):
+        calls.append(sensor_id)
+        return {"id": sensor_id, "version": len(calls)}
+    return load
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(sensor_cache.time, "monotonic", clock)
+    cache = SensorCache(ttl=10)
+    calls = []
+    load = loader(calls)
+
+    assert cache.get(1, load) == {"id": 1, "version": 1}
+    clock.now += 9.9
+    assert cache.get(1, load) == {"id": 1, "version": 1}
+    clock.now += 0.1
+    assert cache.get(1, load) == {"id": 1, "version": 2}
+    assert calls == [1, 1]
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+
+def test_copies_are_returned():
+    cache = SensorCache()
+    doc = cache.get(1, lambda sensor_id: {"id": sensor_id})
+    doc["battery_level"] = 0.1
+    assert cache.get(1, lambda sensor_id: None) == {"id": 1}
+
+
+def test_missing_sensors_are_not_cached():
+    cache = SensorCache()
+    assert cache.get(1, lambda sensor_id: None) is None
+    assert cache.get(1, lambda sensor_id: {"id": sensor_id}) == {"id": 1}
+
+
+def test_load_racing_an_invalidation_is_not_cached():
+    cache = SensorCache()
+
+    def stale_load(sensor_id):
+        # The sensor is deleted while its old document is being read
+        cache.invalidate(sensor_id)
+        return {"id": sensor_id, "name": "old"}
+
+    assert cache.get(1, stale_load) == {"id": 1, "name": "old"}
+    assert cache.get(1, lambda sensor_id: {"id": sensor_id, "name": "new"}) == {"id": 1, "name": "new"}
+
+
+def test_get_many_racing_a_clear_is_not_cached():
+    cache = SensorCache()
+
+    def stale_load_many(ids):
+        cache.clear()
+        return {sensor_id: {"id": sensor_id} for sensor_id in ids}
+
+    assert cache.get_many([1, 2], stale_load_many) == {1: {"id": 1}, 2: {"id": 2}}
+    assert cache.stats()["size"] == 0
+    cache.get_many([1, 2], lambda ids: {sensor_id: {"id": sensor_id} for sensor_id in ids})
+    assert cache.get_many([1, 2], lambda ids: {}) == {1: {"id": 1}, 2: {"id": 2}}
+
+
+def test_least_recently_used_is_evicted():
+    cache = SensorCache(max_size=2)
+    load = loader([])
+    cache.get(1, load)
+    cache.get(2, load)
+    cache.get(1, load)
+    cache.get(3, load)
+    assert cache.get_many([1, 3], lambda ids: {}) == {1: {"id": 1, "version": 1}, 3: {"id": 3, "version": 3}}
+    assert cache.stats()["evictions"] == 1
+    assert cache.get(2, load) == {"id": 2, "version": 4}
@@ -0,0 +1,154 @@
+import types
+
+import pika
+
+from shared import retry
+from shared import subscriber as subscriber_module
+from shared.subscriber import Delivery, Subscriber
+
+
+class FakeChannel:
+    # Records the calls that matter, accepts any other
+    def __init__(self, messages=(), fail_publish=False):
+        self.messages = list(messages)
+        self.fail_publish = fail_publish
+        self.acks = []
+        self.nacks = []
+        self.published = []
+        self.on_message = None
+
+    def basic_consume(self, queue, on_message_callback, auto_ack):
+        self.on_message = on_message_callback
+
+    def start_consuming(self):
+        for message in self.messages:
+            self.on_message(self, *message)
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acks.append((delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+        self.nacks.append((delivery_tag, multiple, requeue))
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        if self.fail_publish:
+            raise pika.exceptions.ChannelClosed(404, "NOT_FOUND")
+        self.published.append((routing_key, body))
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class FakeConnection:
+    def __init__(self):
+        self.timers = []
+
+    def call_later(self, delay, callback):
+        self.timers.append(callback)
+        return callback
+
+    def remove_timeout(self, timer):
+        self.timers.remove(timer)
+
+
+def message(tag):
+    return (types.SimpleNamespace(delivery_tag=tag),
+            pika.BasicProperties(message_id=f"id{tag}", content_type="application/json"),
+            f"body{tag}".encode())
+
+
+class Recorder:
+    # on_batch that keeps what it was given and fails on the bodies in `bad`
+    def __init__(self, bad=()):
+        self.bad = set(bad)
+        self.batches = []
+        self.written = []
+
+    def __call__(self, deliveries, split=False):
+        self.batches.append(([delivery.body for delivery in deliveries], split))
+        if any(delivery.body in self.bad for delivery in deliveries):
+            raise ValueError("bad reading")
+        self.written += [delivery.body for delivery in deliveries]
+
+
+def subscriber(channel, on_batch, batch_size=3, flush_interval=0.2):
+    sub = Subscriber.__new__(Subscriber)
+    sub.conn, sub.channel = FakeConnection(), channel
+    sub._batch, sub._timer = [], None
+    sub._queue, sub._on_batch = "q", on_batch
+    sub._batch_size, sub._flush_interval = batch_size, flush_interval
+    return sub
+
+
+def test_full_batch_is_acked_once_on_its_last_tag():
+    channel, batches = FakeChannel(), []
+    sub = subscriber(channel, lambda deliveries, split: batches.append(deliveries))
+    for tag in (1, 2, 3):
+        sub._on_message(channel, *message(tag))
+    assert batches == [[Delivery(f"id{tag}", "application/json", f"body{tag}".encode()) for tag in (1, 2, 3)]]
+    assert channel.acks == [(3, True)]
+    assert sub.conn.timers == []
+
+
+def test_timer_flushes_a_partial_batch():
+    channel, on_batch = FakeChannel(), Recorder()
+    sub = subscriber(channel, on_batch)
+    sub._on_message(channel, *message(1))
+    sub._on_message(channel, *message(2))
+    assert on_batch.batches == [] and len(sub.conn.timers) == 1
+    sub.conn.timers[0]()
+    assert on_batch.batches == [([b"body1", b"body2"], False)]
+    assert channel.acks == [(2, True)]
+
+
+def test_pending_batch_is_flushed_at_shutdown(monkeypatch):
+    # Keep pytest's own SIGTERM handler
+    monkeypatch.setattr(subscriber_module.signal, "signal", lambda signum, handler: None)
+    channel, on_batch = FakeChannel([message(1), message(2), message(3), message(4)]), Recorder()
+    sub = subscriber(channel, on_batch)
+    sub.subscribe_batch("q", on_batch, batch_size=3)
+    assert [len(bodies) for bodies, _ in on_batch.batches] == [3, 1]
+    assert channel.acks == [(3, True), (4, True)]
+    assert sub.conn.timers == []
+
+
+def test_failed_batch_goes_to_the_delay_queue_and_is_acked():
+    channel = FakeChannel()
+    sub = subscriber(channel, on_batch=Recorder(bad={b"body1", b"body2"}), batch_size=2)
+    sub._on_message(channel, *message(1))
+    sub._on_message(channel, *message(2))
+    assert [body for _, body in channel.published] == [b"body1", b"body2"]
+    assert channel.acks == [(2, True)] and channel.nacks == []
+
+
+def test_only_the_bad_message_of_a_failed_batch_is_retried():
+    channel, on_batch = FakeChannel(), Recorder(bad={b"body3"})
+    sub = subscriber(channel, on_batch, batch_size=4)
+    for tag in (1, 2, 3, 4):
+        sub._on_message(channel, *message(tag))
+    assert on_batch.batches == [([b"body1", b"body2", b"body3", b"body4"], False), ([b"body1", b"body2"], True),
+                                ([b"body3", b"body4"], True), ([b"body3"], True), ([b"body4"], True)]
+    assert on_batch.written == [b"body1", b"body2", b"body4"]
+    assert channel.published == [("q.retry.1s", b"body3")]
+    assert channel.acks == [(4, True)]
+
+
+def test_splitting_stops_after_the_attempt_budget(monkeypatch):
+    monkeypatch.setattr(retry, "SPLIT_ATTEMPTS", 2)
+    channel = FakeChannel()
+    on_batch = Recorder(bad={f"body{tag}".encode() for tag in range(1, 9)})
+    sub = subscriber(channel, on_batch, batch_size=8)
+    for tag in range(1, 9):
+        sub._on_message(channel, *message(tag))
+    assert len(on_batch.batches) == 3
+    assert [body for _, body in channel.published] == [f"body{tag}".encode() for tag in range(1, 9)]
+    assert channel.acks == [(8, True)]
+
+
+def test_batch_is_requeued_when_the_retry_publish_fails():
+    channel = FakeChannel(fail_publish=True)
+    sub = subscriber(channel, on_batch=Recorder(bad={b"body1"}), batch_size=2)
+    sub._on_message(channel, *message(1))
+    sub._on_message(channel, *message(2))
+    assert channel.nacks == [(2, True, True)]
+    assert channel.acks == []
@@ -1,4 +1,5 @@
 import psycopg2
+import psycopg2.extras
 import os
 
 
@@ -10,6 +11,7 @@ class Timescale:
             user=os.environ.get("TS_USER"),
             password=os.environ.get("TS_PASSWORD"),
             database=os.environ.get("TS_DBNAME"))
+        self.conn.autocommit = True
         self.cursor = self.conn.cursor()
         
     def getCursor(self):
@@ -22,8 +24,14 @@ class Timescale:
     def ping(self):
         return self.conn.ping()
     
-    def execute(self, query):
-       return self.cursor.execute(query)
+    def execute(self, query, params=None):
+        if params:
+            return self.cursor.execute(query, params)
+        else:
+            return self.cursor.execute(query)
+
+    def execute_values(self, query, rows, page_size=1000):
+        return psycopg2.extras.execute_values(self.cursor, query, rows, page_size=page_size)
     
     def delete(self, table):
         self.cursor.execute("DELETE FROM " + table)